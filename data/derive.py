@@ -0,0 +1,187 @@
+# derive.py
+# Derive token-level languages from the output of their control language
+
+import sys
+import os
+import argparse
+import shutil
+import numpy as np
+from numpy.random import default_rng
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from utils import PERTURBATIONS, BABYLM_SPLITS, BABYLM_DATA_PATH, \
+    TOKEN_IDX_EXT, write_file, write_token_arrays, list_token_files, \
+    read_token_file, read_token_sequences, is_token_perturbation, \
+    derive_from_control, perturb_sents, perturb_shuffle_even_odd
+from perturb import resolve_perturbations, to_text_lines
+
+
+# Every token-level language is a reordering of the GPT-2 ids its control
+# language wrote: shuffle_control for the shuffles, reverse_control for the
+# reversals. Deriving them from those outputs needs no tagged files or
+# tokenization. Outputs are written like perturb.py writes them.
+
+
+def get_control_type(perturbation_type):
+    """
+    Name of the control language a perturbation is derived from, e.g.
+    lemma_shuffle_control for lemma_shuffle_local3.
+    """
+    perturbation = PERTURBATIONS[perturbation_type]
+    if not is_token_perturbation(perturbation["perturbation_function"]):
+        raise ValueError(f"{perturbation_type} is not a token-level perturbation")
+
+    for family in ("shuffle_", "reverse_"):
+        i = perturbation_type.find(family)
+        if i < 0:
+            continue
+        control_type = perturbation_type[:i + len(family)] + "control"
+        control = PERTURBATIONS.get(control_type)
+        if control is not None and all(control[key] is perturbation[key] for key in
+                                       ("affect_function", "filter_function", "gpt2_tokenizer")):
+            try:
+                derive_from_control([], [], perturbation["perturbation_function"])
+            except ValueError:
+                raise ValueError(f"{perturbation_type} is not a reordering of {control_type}")
+            return control_type
+    raise ValueError(f"No control language to derive {perturbation_type} from")
+
+
+def read_token_arrays(path):
+    """
+    Flat int64 ids and sequence lengths of a token file, in either format.
+    """
+    if os.path.exists(path + TOKEN_IDX_EXT):
+        tokens, offsets = read_token_file(path)
+    else:
+        sequences = read_token_sequences(path)
+        offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+        np.cumsum([len(tokens) for tokens in sequences], out=offsets[1:])
+        tokens = [tok for tokens in sequences for tok in tokens]
+    return np.asarray(tokens, dtype=np.int64), np.diff(offsets)
+
+
+def derive_file(path, out_dir, perturbation_function, text=False):
+    tokens, lengths = read_token_arrays(path)
+    function = getattr(perturbation_function, "func", perturbation_function)
+    if function is perturb_shuffle_even_odd and np.any(lengths == 1024):
+        print(f"[Warning] {path} has sentences of 1024 tokens, which the "
+              "control may have truncated; shuffle_even_odd does not truncate.")
+
+    derived = derive_from_control(tokens, lengths, perturbation_function)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    filename = os.path.basename(path)
+    write_token_arrays(out_dir, filename, derived, offsets)
+    if text:
+        derived = derived.tolist()
+        write_file(out_dir, filename, to_text_lines(
+            [derived[offsets[i]:offsets[i+1]] for i in range(len(lengths))]))
+
+
+def get_split_dirs(babylm_dataset):
+    """
+    Subdirectories of a language directory that hold token files of a
+    split, and those holding text that is copied as is.
+    """
+    if babylm_dataset == "unittest":
+        raise ValueError("The unittest split is written as decoded text and "
+                         "cannot be derived; run perturb.py instead")
+    if babylm_dataset == "test":
+        return ["babylm_test_affected", "babylm_test_unaffected"], \
+            ["babylm_test_unaffected_sents"]
+    return [f"babylm_{babylm_dataset}"], []
+
+
+def derive(perturbation_type, babylm_dataset, text=False):
+    control_type = get_control_type(perturbation_type)
+    perturbation_function = PERTURBATIONS[perturbation_type]["perturbation_function"]
+
+    perturbed_path = f"{BABYLM_DATA_PATH}/babylm_data_perturbed"
+    token_dirs, copied_dirs = get_split_dirs(babylm_dataset)
+    for subdir in token_dirs:
+        source_dir = f"{perturbed_path}/babylm_{control_type}/{subdir}/"
+        out_dir = f"{perturbed_path}/babylm_{perturbation_type}/{subdir}/"
+        paths = list_token_files(source_dir)
+        if len(paths) == 0:
+            print(f"[Warning] No {control_type} outputs in {source_dir} – "
+                  "run perturb.py for it first.")
+            continue
+        os.makedirs(out_dir, exist_ok=True)
+        for path in paths:
+            print(f"Deriving {out_dir}{os.path.basename(path)}")
+            derive_file(path, out_dir, perturbation_function, text)
+
+    for subdir in copied_dirs:
+        source_dir = f"{perturbed_path}/babylm_{control_type}/{subdir}/"
+        if os.path.isdir(source_dir):
+            shutil.copytree(source_dir, f"{perturbed_path}/babylm_{perturbation_type}/{subdir}/",
+                            dirs_exist_ok=True)
+
+
+def test_derive_from_control():
+    rng = default_rng(0)
+    sents = [{"sent_text": "derive", "gpt2_ids": rng.integers(0, 50000, length).tolist()}
+             for length in [0, 1, 2, 3, 7, 10, 64, 1024]]
+
+    for perturbation_type, perturbation in PERTURBATIONS.items():
+        perturbation_function = perturbation["perturbation_function"]
+        try:
+            control_type = get_control_type(perturbation_type)
+        except ValueError:
+            continue
+
+        # Randomized perturbations and their control draw from the same streams
+        control_function = PERTURBATIONS[control_type]["perturbation_function"]
+        control = perturb_sents(sents, control_function,
+                                [default_rng(k) for k in range(len(sents))])
+        expected = perturb_sents(sents, perturbation_function,
+                                 [default_rng(k) for k in range(len(sents))])
+
+        lengths = [len(tokens) for tokens in control]
+        derived = derive_from_control(
+            [tok for tokens in control for tok in tokens], lengths,
+            perturbation_function).tolist()
+        ends = np.cumsum(lengths).tolist()
+        assert [derived[end - length:end] for end, length in zip(ends, lengths)] \
+            == expected, perturbation_type
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Derive token-level languages from the perturb.py '
+        'output of their control language, without tagged files or '
+        'tokenization')
+    parser.add_argument('perturbation_types', nargs='+',
+                        help="Perturbation names or families such as "
+                        "'shuffle_local*' (quoted)")
+    parser.add_argument('babylm_dataset', choices=BABYLM_SPLITS)
+    parser.add_argument('--text', action='store_true',
+                        help="Also export token files as space-separated "
+                        "ids next to the binary .bin/.idx files")
+    args = parser.parse_args()
+
+    try:
+        perturbation_types = resolve_perturbations(args.perturbation_types)
+        get_split_dirs(args.babylm_dataset)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # Families may include languages that can only be built by perturb.py
+    controls = {}
+    for perturbation_type in perturbation_types:
+        try:
+            controls[perturbation_type] = get_control_type(perturbation_type)
+        except ValueError as e:
+            print(f"[Warning] {e} – skipping it.")
+    if len(controls) == 0:
+        parser.error("None of the perturbations can be derived")
+
+    for perturbation_type in controls:
+        if controls[perturbation_type] == perturbation_type:
+            print(f"Skipping {perturbation_type}: it is a control language")
+            continue
+        print(f"Deriving {perturbation_type} from {controls[perturbation_type]}")
+        derive(perturbation_type, args.babylm_dataset, args.text)
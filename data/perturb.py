@@ -5,7 +5,17 @@ import os
 import json
 import argparse
 import tqdm
-from glob import glob
+import zlib
+import fnmatch
+import hashlib
+import pytest
+from functools import partial
+from collections import deque
+import itertools
+import multiprocessing
+import shutil
+import time
+import numpy as np
 
 # ----- MODIFIED: Adjust path to project -----
 # sys.path.append("/home/s2678328/mission-impossible-language-models")
@@ -15,102 +25,726 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 
 from utils import PERTURBATIONS, BABYLM_SPLITS, BABYLM_DATA_PATH, \
-    MARKER_TOKEN_IDS, write_file
+    MARKER_TOKEN_IDS, TOKEN_BIN_EXT, TOKEN_IDX_EXT, get_rng_seed, \
+    get_sentence_rng, add_gpt2_ids, is_token_perturbation, perturb_sents, \
+    SentenceContext, HOP_WORD_PLACEMENTS, HOP_TOKEN_ENGINES, MARKER_HOP_SING, \
+    MARKER_HOP_PLUR, perturb_shuffle_deterministic, perturb_shuffle_local
+from numpy.random import default_rng
+from tagged_corpus import COLUMNAR_EXT, read_tagged, list_tagged_files
 
 # ----- MODIFIED: Flatten in-place processing -----
 
-def process_line(line, perturbation_function, affect_function, filter_function):
+def process_line(line, perturbation_function, affect_function, filter_function,
+                 perturbed=None, profile=None):
+    """
+    Returns the token lists of affected and unaffected sentences and the
+    text of unaffected sentences. perturbed, if given, holds the already
+    perturbed tokens of each sentence. Times and sentence counts are added
+    to profile, a perturbation entry of new_profile, if given.
+    """
     new_lines_affected = []
     new_lines_unaffected = []
     sents_unaffected = []
 
-    for sent in line["sent_annotations"]:
-        tokens = perturbation_function(sent)
+    # Tokenizations and hop placements are computed once per sentence
+    sents = [sent if isinstance(sent, SentenceContext) else SentenceContext(sent)
+             for sent in line["sent_annotations"]]
+    if perturbed is None:
+        perturbed = timed(profile, "perturbation_function",
+                          perturb_sents, sents, perturbation_function)
+
+    for sent, tokens in zip(sents, perturbed):
+        count(profile, "sentences")
         if len([tok for tok in tokens if tok not in MARKER_TOKEN_IDS]) <= 1:
+            count(profile, "dropped")
             continue
 
-        token_line = " ".join([str(tok) for tok in tokens])
-
-        if affect_function(sent):
-            if filter_function(sent):
-                new_lines_affected.append(token_line + "\n")
+        if timed(profile, "affect_function", affect_function, sent):
+            if timed(profile, "filter_function", filter_function, sent):
+                count(profile, "affected")
+                new_lines_affected.append(tokens)
+            else:
+                count(profile, "filtered_out")
         else:
-            new_lines_unaffected.append(token_line + "\n")
+            count(profile, "unaffected")
+            new_lines_unaffected.append(tokens)
             sents_unaffected.append(sent["sent_text"] + "\n")
 
     return new_lines_affected, new_lines_unaffected, sents_unaffected
 
 
+def __call_or_error(function, *args):
+    try:
+        return function(*args)
+    except Exception as e:
+        return repr(e)
+
+
+def test_hop_engines_equivalent():
+    files = list_tagged_files(f"{BABYLM_DATA_PATH}/unittest")
+    if len(files) == 0:
+        pytest.skip("Tagged unittest split not found")
+
+    for file in files:
+        for line in read_tagged(file):
+            for sent in line["sent_annotations"]:
+                if "word_annotations" not in sent:
+                    continue
+                for num_hops in (0, 4):
+                    words_args = (sent, num_hops, MARKER_HOP_SING, MARKER_HOP_PLUR)
+                    assert __call_or_error(HOP_WORD_PLACEMENTS["linear"], *words_args) == \
+                        __call_or_error(HOP_WORD_PLACEMENTS["quadratic"], *words_args), \
+                        sent["sent_text"]
+                    assert __call_or_error(HOP_TOKEN_ENGINES["linear"], sent, num_hops) == \
+                        __call_or_error(HOP_TOKEN_ENGINES["quadratic"], sent, num_hops), \
+                        sent["sent_text"]
+
+
+def __shuffle_with_generators(tokens, function, keywords):
+    # Original implementations, drawing a new generator per sentence or window
+    tokens = tokens[:1024]
+    if function is perturb_shuffle_deterministic:
+        if keywords["shuffle"]:
+            default_rng(keywords["seed"]).shuffle(tokens)
+        return tokens
+    shuffled_tokens = []
+    for i in range(0, len(tokens), keywords["window"]):
+        batch = tokens[i:i+keywords["window"]].copy()
+        default_rng(keywords["seed"]).shuffle(batch)
+        shuffled_tokens += batch
+    return shuffled_tokens
+
+
+def test_shuffle_tables_match_generators():
+    rng = default_rng(0)
+    sents = [{"sent_text": "shuffle", "gpt2_ids": rng.integers(0, 50000, length).tolist()}
+             for length in list(range(40)) + [1023, 1024, 1500]]
+
+    for perturbation_type, perturbation in PERTURBATIONS.items():
+        perturbation_function = perturbation["perturbation_function"]
+        function = getattr(perturbation_function, "func", perturbation_function)
+        if function not in (perturb_shuffle_deterministic, perturb_shuffle_local):
+            continue
+        expected = [__shuffle_with_generators(
+            list(sent["gpt2_ids"]), function, perturbation_function.keywords)
+            for sent in sents]
+        assert [perturbation_function(sent) for sent in sents] == expected, \
+            perturbation_type
+        assert perturb_sents(sents, perturbation_function) == expected, \
+            perturbation_type
+
+
+# ----- PROFILING -----
+# With --profile, wall time is recorded per stage: reading the tagged files,
+# tokenizing sentences, and, for every language, its perturbation, affect
+# and filter functions and writing its outputs. Sentences are counted as
+# affected, filtered out, unaffected, or dropped for having at most one
+# non-marker token. Values memoized on a sentence (tokenizations, hop
+# placements) are timed under whichever function computes them first.
+# With several workers, stage times are summed over processes.
+
+PROFILE_STAGES = ["read", "tokenize"]
+PROFILE_TIMINGS = ["perturbation_function", "affect_function",
+                   "filter_function", "write"]
+PROFILE_COUNTS = ["sentences", "affected", "filtered_out", "unaffected",
+                  "dropped"]
+
+
+def new_profile(num_perturbations):
+    return {
+        "stages": dict.fromkeys(PROFILE_STAGES, 0.0),
+        "perturbations": [{"timings": dict.fromkeys(PROFILE_TIMINGS, 0.0),
+                           "counts": dict.fromkeys(PROFILE_COUNTS, 0)}
+                          for _ in range(num_perturbations)],
+    }
+
+
+def add_profile_entry(entry, other):
+    for key in ("timings", "counts"):
+        for name, value in other[key].items():
+            entry[key][name] += value
+
+
+def merge_profile(profile, other):
+    for stage, seconds in other["stages"].items():
+        profile["stages"][stage] += seconds
+    for entry, other_entry in zip(profile["perturbations"], other["perturbations"]):
+        add_profile_entry(entry, other_entry)
+
+
+def timed(timings, key, function, *args):
+    """
+    Call function, adding its wall time to timings[key] (or to
+    timings["timings"][key] for a perturbation entry) unless timings is
+    None.
+    """
+    if timings is None:
+        return function(*args)
+    start = time.perf_counter()
+    try:
+        return function(*args)
+    finally:
+        timings.get("timings", timings)[key] += time.perf_counter() - start
+
+
+def count(profile, key):
+    if profile is not None:
+        profile["counts"][key] += 1
+
+
+def new_profile_report(babylm_dataset, options):
+    return {"split": babylm_dataset, "options": options,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S"), "wall": 0.0,
+            "files": [], "stages": dict.fromkeys(PROFILE_STAGES, 0.0),
+            "languages": {}}
+
+
+def add_file_profile(report, file, perturbation_types, profile):
+    report["files"].append(file)
+    for stage, seconds in profile["stages"].items():
+        report["stages"][stage] += seconds
+    for perturbation_type, entry in zip(perturbation_types, profile["perturbations"]):
+        if perturbation_type not in report["languages"]:
+            perturbation = PERTURBATIONS[perturbation_type]
+            report["languages"][perturbation_type] = {
+                "functions": {name: describe_function(perturbation[name]) for name in
+                              ("perturbation_function", "affect_function", "filter_function")},
+                "timings": dict.fromkeys(PROFILE_TIMINGS, 0.0),
+                "counts": dict.fromkeys(PROFILE_COUNTS, 0),
+            }
+        add_profile_entry(report["languages"][perturbation_type], entry)
+
+
+def save_profile_report(report):
+    """
+    Write a profile report to a timestamped JSON file under
+    babylm_data_perturbed/profiles, so that builds can be compared, and
+    return its path.
+    """
+    directory = f"{BABYLM_DATA_PATH}/babylm_data_perturbed/profiles"
+    os.makedirs(directory, exist_ok=True)
+    filename = f"{directory}/perturb_{report['split']}_{time.strftime('%Y%m%d-%H%M%S')}.json"
+    with open(filename, "w") as f:
+        json.dump(report, f, indent=4)
+    return filename
+
+
+# ----- BATCHED AND PARALLEL MODES -----
+# Lines are processed in tasks of LINES_PER_TASK lines, whose sentences are
+# tokenized together. A line of a tagged file already holds a batch of up to
+# 2000 source lines (tag.py's BATCH_SIZE), so a task is a single line. Every
+# line is dispatched to each requested perturbation, so a tagged file is read
+# and tokenized once however many languages are built from it. With several
+# workers, tasks are sent to forked processes while at most TASKS_PER_WORKER
+# tasks per worker are pending, so the streamed input is never read far
+# ahead of the output. Results come back in line order.
+
+LINES_PER_TASK = 1
+TASKS_PER_WORKER = 2
+
+__perturb_state = {}
+
+
+def __process_lines(lines):
+    state = __perturb_state
+    perturbations = state["perturbations"]
+    profile = new_profile(len(perturbations)) if state["profile"] else None
+    stages = profile["stages"] if profile is not None else None
+
+    # Every perturbation of a line shares the memoized values of its sentences
+    for _, line in lines:
+        line["sent_annotations"] = [SentenceContext(sent)
+                                    for sent in line["sent_annotations"]]
+    if any(is_token_perturbation(p["perturbation_function"]) for p in perturbations):
+        timed(stages, "tokenize", add_gpt2_ids,
+              [sent for _, line in lines for sent in line["sent_annotations"]])
+
+    # Each perturbation is applied to all sentences of the task at once.
+    # Sentences keep their line order, so a shared generator is drawn from
+    # in the same order as line by line.
+    sents = [sent for _, line in lines for sent in line["sent_annotations"]]
+    ends = list(itertools.accumulate(len(line["sent_annotations"]) for _, line in lines))
+    perturbed = []
+    for i, (perturbation, seed) in enumerate(zip(perturbations, state["seeds"])):
+        rngs = None
+        if state["per_sentence_rng"] and seed is not None:
+            rngs = [get_sentence_rng(seed, state["file_key"], line_index, k)
+                    for line_index, line in lines
+                    for k in range(len(line["sent_annotations"]))]
+        tokens = timed(profile and profile["perturbations"][i], "perturbation_function",
+                       perturb_sents, sents, perturbation["perturbation_function"], rngs)
+        perturbed.append([tokens[end - len(line["sent_annotations"]):end]
+                          for end, (_, line) in zip(ends, lines)])
+
+    results = []
+    for k, (_, line) in enumerate(lines):
+        results.append([process_line(
+            line, perturbation["perturbation_function"],
+            perturbation["affect_function"],
+            perturbation["filter_function"], perturbed=line_perturbed[k],
+            profile=profile and profile["perturbations"][i])
+            for i, (perturbation, line_perturbed) in enumerate(zip(perturbations, perturbed))])
+    return results, profile
+
+
+def process_lines(data, file_key, num_workers, perturbations, profile=None):
+    """
+    For every line of data, yield a list with the process_line results of
+    each perturbation (entries of PERTURBATIONS). With num_workers > 1 they
+    are computed by a pool of processes. With num_workers > 0, randomized
+    perturbations use per-sentence generators, so the output does not
+    depend on num_workers; with 0 they share the bound generator. Stage
+    times and sentence counts are added to profile (see new_profile), if
+    given.
+    """
+    __perturb_state.update(
+        perturbations=perturbations,
+        seeds=[get_rng_seed(p["perturbation_function"]) for p in perturbations],
+        per_sentence_rng=num_workers > 0,
+        file_key=file_key,
+        profile=profile is not None,
+    )
+
+    # Reading the input is timed as the tagged file is streamed
+    lines = enumerate(data)
+    stages = profile["stages"] if profile is not None else None
+
+    def next_task(size):
+        return timed(stages, "read", lambda: list(itertools.islice(lines, size)))
+
+    def merged(results, task_profile):
+        if profile is not None:
+            merge_profile(profile, task_profile)
+        return results
+
+    try:
+        if num_workers <= 1:
+            for task in iter(lambda: next_task(LINES_PER_TASK), []):
+                yield from merged(*__process_lines(task))
+            return
+
+        # Pool.imap would read the whole input ahead, so pending tasks are
+        # kept in a bounded queue and collected oldest first
+        ctx = multiprocessing.get_context("fork")
+        with ctx.Pool(num_workers) as pool:
+            pending = deque()
+            for task in iter(lambda: next_task(LINES_PER_TASK), []):
+                pending.append(pool.apply_async(__process_lines, (task,)))
+                if len(pending) >= num_workers * TASKS_PER_WORKER:
+                    yield from merged(*pending.popleft().get())
+            while len(pending) > 0:
+                yield from merged(*pending.popleft().get())
+    finally:
+        __perturb_state.clear()
+
+
+def get_file_key(file):
+    """
+    Key of a tagged file's random streams. It hashes the path relative to
+    BABYLM_DATA_PATH, so a genre gets different streams in every split but
+    the same ones wherever the data directory is.
+    """
+    path = os.path.relpath(file, BABYLM_DATA_PATH).replace(os.sep, "/")
+    return zlib.crc32(path.encode("utf-8"))
+
+
+def resolve_perturbations(patterns):
+    """
+    Expand perturbation names and shell-style families such as 'shuffle_*'
+    into registry names, in registry order.
+    """
+    names = set()
+    for pattern in patterns:
+        matches = fnmatch.filter(PERTURBATIONS.keys(), pattern)
+        if len(matches) == 0:
+            raise ValueError(f"No perturbation matches '{pattern}'")
+        names.update(matches)
+    return [name for name in PERTURBATIONS if name in names]
+
+
+def to_text_lines(token_lists):
+    return [" ".join([str(tok) for tok in tokens]) + "\n" for tokens in token_lists]
+
+
+# ----- STREAMING OUTPUTS -----
+# Token lists are appended to temporary shards, one per output category, as
+# lines are perturbed: uint16 ids, the running int64 offsets and, if
+# requested, text lines. Once a tagged file is done, the shards are
+# stitched into the final files in the usual order (unaffected before
+# affected for train and dev), so memory use does not grow with the size
+# of a genre.
+
+SHARD_EXT = ".shard"
+
+
+def __open_shard(path, binary=True, text=False, tokenizer=None):
+    shard = {"path": path + SHARD_EXT, "num_tokens": 0, "binary": binary,
+             "tokenizer": tokenizer, "bin": None, "idx": None, "text": None}
+    if binary:
+        shard["bin"] = open(shard["path"] + TOKEN_BIN_EXT, "wb")
+        shard["idx"] = open(shard["path"] + TOKEN_IDX_EXT, "wb")
+        np.zeros(1, dtype="<i8").tofile(shard["idx"])
+    if text:
+        shard["text"] = open(shard["path"], "w")
+    return shard
+
+
+def __append_shard(shard, token_lists):
+    if len(token_lists) == 0:
+        return
+    if shard["binary"]:
+        lengths = np.array([len(tokens) for tokens in token_lists], dtype=np.int64)
+        tokens = np.fromiter(itertools.chain.from_iterable(token_lists),
+                             dtype=np.int64, count=lengths.sum())
+        if len(tokens) > 0 and (tokens.min() < 0 or tokens.max() > np.iinfo(np.uint16).max):
+            raise ValueError(f"Token ids of {shard['path']} do not fit in uint16")
+        tokens.astype("<u2").tofile(shard["bin"])
+        (shard["num_tokens"] + np.cumsum(lengths)).astype("<i8").tofile(shard["idx"])
+        shard["num_tokens"] += int(lengths.sum())
+    if shard["text"] is not None:
+        lines = to_text_lines(token_lists)
+        if shard["tokenizer"] is not None:
+            # Interleave decoded sentences, as in the unittest split
+            lines = [l for pair in zip(lines, [shard["tokenizer"].decode(tokens) + "\n"
+                                               for tokens in token_lists]) for l in pair]
+        shard["text"].writelines(lines)
+
+
+def __stitch_shards(shards, path):
+    """
+    Concatenate shards into the output files at path, remove them, and
+    return the paths written.
+    """
+    for shard in shards:
+        for key in ("bin", "idx", "text"):
+            if shard[key] is not None:
+                shard[key].close()
+
+    paths = []
+    if len(shards) == 1:
+        for ext in (TOKEN_BIN_EXT, TOKEN_IDX_EXT, ""):
+            if os.path.exists(shards[0]["path"] + ext):
+                os.replace(shards[0]["path"] + ext, path + ext)
+                paths.append(path + ext)
+        return paths
+
+    if shards[0]["binary"]:
+        with open(path + TOKEN_BIN_EXT, "wb") as out:
+            for shard in shards:
+                with open(shard["path"] + TOKEN_BIN_EXT, "rb") as f:
+                    shutil.copyfileobj(f, out)
+        with open(path + TOKEN_IDX_EXT, "wb") as out:
+            np.zeros(1, dtype="<i8").tofile(out)
+            num_tokens = 0
+            for shard in shards:
+                with open(shard["path"] + TOKEN_IDX_EXT, "rb") as f:
+                    # Skip the leading 0 of every shard
+                    f.seek(np.dtype("<i8").itemsize)
+                    offsets = np.fromfile(f, dtype="<i8", count=1 << 20)
+                    while len(offsets) > 0:
+                        (offsets + num_tokens).tofile(out)
+                        offsets = np.fromfile(f, dtype="<i8", count=1 << 20)
+                num_tokens += shard["num_tokens"]
+        paths += [path + TOKEN_BIN_EXT, path + TOKEN_IDX_EXT]
+    if shards[0]["text"] is not None:
+        with open(path, "w") as out:
+            for shard in shards:
+                with open(shard["path"]) as f:
+                    shutil.copyfileobj(f, out)
+        paths.append(path)
+
+    for shard in shards:
+        for ext in (TOKEN_BIN_EXT, TOKEN_IDX_EXT, ""):
+            if os.path.exists(shard["path"] + ext):
+                os.remove(shard["path"] + ext)
+    return paths
+
+
+def open_outputs(perturbation_type, babylm_dataset, file, text=False):
+    """
+    Open the output shards for one perturbation of one tagged file. Token
+    files (.bin/.idx, plus the space-separated text format if text is set)
+    are written; the unittest split is always written as text, interleaved
+    with decoded sentences.
+    """
+    json_ext = "_parsed.json"
+    gpt2_tokenizer = PERTURBATIONS[perturbation_type]['gpt2_tokenizer']
+    base_name = os.path.basename(file).replace(json_ext, "")
+    out_dir = f"{BABYLM_DATA_PATH}/babylm_data_perturbed/babylm_{perturbation_type}"
+
+    if babylm_dataset == "test":
+        affected = f"{out_dir}/babylm_test_affected/{base_name}_affected.test"
+        unaffected = f"{out_dir}/babylm_test_unaffected/{base_name}_unaffected.test"
+        sents = f"{out_dir}/babylm_test_unaffected_sents/{base_name}_unaffected_sents.test"
+        for path in (affected, unaffected, sents):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        return {
+            "affected": __open_shard(affected, text=text),
+            "unaffected": __open_shard(unaffected, text=text),
+            "sents": open(sents, "w"),
+            "outputs": [(affected, ["affected"]), (unaffected, ["unaffected"])],
+            "sents_path": sents,
+        }
+
+    # Train or dev
+    out_dir = f"{out_dir}/babylm_{babylm_dataset}/"
+    os.makedirs(out_dir, exist_ok=True)
+    if babylm_dataset == "unittest":
+        new_file = out_dir + base_name + ".test"
+        shards = {category: __open_shard(new_file + "." + category, binary=False,
+                                         text=True, tokenizer=gpt2_tokenizer)
+                  for category in ("unaffected", "affected")}
+    else:
+        ext = ".dev" if babylm_dataset == "dev" else ".train"
+        new_file = out_dir + base_name + ext
+        shards = {category: __open_shard(new_file + "." + category, text=text)
+                  for category in ("unaffected", "affected")}
+    return dict(shards, sents=None, sents_path=None,
+                outputs=[(new_file, ["unaffected", "affected"])])
+
+
+def write_outputs(outputs, affected, unaffected, sents):
+    __append_shard(outputs["affected"], affected)
+    __append_shard(outputs["unaffected"], unaffected)
+    if outputs["sents"] is not None:
+        outputs["sents"].writelines(sents)
+
+
+def close_outputs(outputs):
+    """
+    Stitch the shards of open_outputs into the output files and return
+    their paths.
+    """
+    paths = []
+    for path, categories in outputs["outputs"]:
+        paths += __stitch_shards([outputs[category] for category in categories], path)
+    if outputs["sents"] is not None:
+        outputs["sents"].close()
+        paths.append(outputs["sents_path"])
+    return paths
+
+
+# ----- BUILD MANIFEST -----
+# Each perturbation directory keeps one manifest per split, recording for
+# every tagged input file the build key its outputs were made with and the
+# output paths. The key hashes the input file contents, the perturbation's
+# functions and parameters, the tokenizer vocabulary with its added tokens,
+# and the options that change the output. Inputs whose key and outputs are
+# unchanged are skipped. Input hashes are reused while the file's size and
+# modification time are unchanged.
+
+BUILD_VERSION = 2
+
+
+def __hash_input(path):
+    h = hashlib.sha256()
+    files = [path]
+    if os.path.isdir(path):
+        files = sorted(os.path.join(path, name) for name in os.listdir(path))
+    for filename in files:
+        h.update(os.path.basename(filename).encode("utf-8") + b"\0")
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(1 << 24), b""):
+                h.update(block)
+    return h.hexdigest()
+
+
+def __input_stat(path):
+    files = [path]
+    if os.path.isdir(path):
+        files = sorted(os.path.join(path, name) for name in os.listdir(path))
+    return [[os.path.basename(f), os.stat(f).st_size, os.stat(f).st_mtime_ns]
+            for f in files]
+
+
+def get_input_hash(path, manifests):
+    stat = __input_stat(path)
+    for manifest in manifests:
+        entry = manifest["inputs"].get(path)
+        if entry is not None and entry["stat"] == stat:
+            break
+    else:
+        entry = {"stat": stat, "hash": __hash_input(path)}
+    for manifest in manifests:
+        manifest["inputs"][path] = entry
+    return entry["hash"]
+
+
+def describe_function(function):
+    if isinstance(function, partial):
+        keywords = {key: repr(value) for key, value in function.keywords.items()}
+        if "rng" in keywords:
+            keywords["rng"] = f"seed={get_rng_seed(function)}"
+        return {"function": describe_function(function.func),
+                "args": repr(function.args), "keywords": keywords}
+    return f"{function.__module__}.{function.__qualname__}"
+
+
+__tokenizer_hashes = {}
+
+
+def get_tokenizer_hash(tokenizer):
+    if id(tokenizer) not in __tokenizer_hashes:
+        vocab = json.dumps(sorted(tokenizer.get_vocab().items()))
+        added = json.dumps(sorted(tokenizer.get_added_vocab().items()))
+        __tokenizer_hashes[id(tokenizer)] = hashlib.sha256(
+            (type(tokenizer).__name__ + vocab + added).encode("utf-8")).hexdigest()
+    return __tokenizer_hashes[id(tokenizer)]
+
+
+def get_build_key(input_hash, perturbation_type, options):
+    perturbation = PERTURBATIONS[perturbation_type]
+    key = {
+        "version": BUILD_VERSION,
+        "input": input_hash,
+        "perturbation": perturbation_type,
+        "functions": {name: describe_function(perturbation[name]) for name in
+                      ("perturbation_function", "affect_function", "filter_function")},
+        "tokenizer": get_tokenizer_hash(perturbation["gpt2_tokenizer"]),
+        "options": options,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def get_manifest_filename(perturbation_type, babylm_dataset):
+    return f"{BABYLM_DATA_PATH}/babylm_data_perturbed/babylm_{perturbation_type}/.manifest_{babylm_dataset}.json"
+
+
+def load_manifest(manifest_filename):
+    if os.path.exists(manifest_filename):
+        with open(manifest_filename) as f:
+            return json.load(f)
+    return {"inputs": {}, "outputs": {}}
+
+
+def save_manifest(manifest, manifest_filename):
+    os.makedirs(os.path.dirname(manifest_filename), exist_ok=True)
+    with open(manifest_filename + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(manifest_filename + ".tmp", manifest_filename)
+
+
+def is_up_to_date(manifest, file, build_key):
+    entry = manifest["outputs"].get(file)
+    return entry is not None and entry["key"] == build_key and \
+        all(os.path.exists(path) for path in entry["paths"])
+
+
 # ----- MAIN -----
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description='Efficiently perturb BabyLM dataset')
-    parser.add_argument('perturbation_type', choices=PERTURBATIONS.keys())
+    parser.add_argument('perturbation_types', nargs='+',
+                        help="Perturbation names or families such as "
+                        "'shuffle_*' (quoted); each tagged file is read once "
+                        "for all of them")
     parser.add_argument('babylm_dataset', choices=BABYLM_SPLITS)
+    parser.add_argument('-w', '--workers', type=int, default=0,
+                        help="Perturb lines in this many processes, giving "
+                        "each sentence a random stream derived from the "
+                        "seed, file and sentence position; the output is "
+                        "the same for any number of workers. With 0, "
+                        "sentences are processed serially and randomized "
+                        "perturbations share one generator, as before")
+    parser.add_argument('--text', action='store_true',
+                        help="Also export token files as space-separated "
+                        "ids next to the binary .bin/.idx files")
+    parser.add_argument('-f', '--force', action='store_true',
+                        help="Rebuild all outputs, even those whose build "
+                        "manifest shows they are up to date")
+    parser.add_argument('--profile', action='store_true',
+                        help="Record the time spent in each stage and "
+                        "registry function and count sentences by outcome, "
+                        "in a JSON report under babylm_data_perturbed/profiles")
     args = parser.parse_args()
+    start = time.perf_counter()
 
-    perturbation_function = PERTURBATIONS[args.perturbation_type]['perturbation_function']
-    affect_function = PERTURBATIONS[args.perturbation_type]['affect_function']
-    filter_function = PERTURBATIONS[args.perturbation_type]['filter_function']
-    gpt2_tokenizer = PERTURBATIONS[args.perturbation_type]['gpt2_tokenizer']
-
+    try:
+        perturbation_types = resolve_perturbations(args.perturbation_types)
+    except ValueError as e:
+        parser.error(str(e))
+    print(f"Perturbations: {', '.join(perturbation_types)}")
 
     print (f"value BABYLM_DATA_PATH is {BABYLM_DATA_PATH}")
     babylm_dataset = args.babylm_dataset
-    json_ext = "_parsed.json"
-    babylm_data = glob(
-        f"{BABYLM_DATA_PATH}/{babylm_dataset}/*.json")
+    # A converted JSON file is only read in its columnar format
+    babylm_data = list_tagged_files(f"{BABYLM_DATA_PATH}/{babylm_dataset}")
     print(f"Found {len(babylm_data)} files in {BABYLM_DATA_PATH}/{babylm_dataset}")
     print (f"processing the folds on {babylm_data}")
     for file in babylm_data:
         print (file)
 
-    for file in babylm_data:
-        print(f"Processing {file}")
-        with open(file, 'r') as f:
-            data = json.load(f)
-
-        # Stream and write output
-        affected, unaffected, sents = [], [], []
-        for line in tqdm.tqdm(data):
-            a, u, s = process_line(
-                line, perturbation_function, affect_function, filter_function)
-            affected.extend(a)
-            unaffected.extend(u)
-            sents.extend(s)
-
-        if babylm_dataset == "test":
-            out_dir = f"{BABYLM_DATA_PATH}/babylm_data_perturbed/babylm_{args.perturbation_type}"
-            os.makedirs(f"{out_dir}/babylm_test_affected", exist_ok=True)
-            os.makedirs(f"{out_dir}/babylm_test_unaffected", exist_ok=True)
-            os.makedirs(
-                f"{out_dir}/babylm_test_unaffected_sents", exist_ok=True)
-
-            base_name = os.path.basename(file).replace(json_ext, "")
-            write_file(f"{out_dir}/babylm_test_affected",
-                       f"{base_name}_affected.test", affected)
-            write_file(f"{out_dir}/babylm_test_unaffected",
-                       f"{base_name}_unaffected.test", unaffected)
-            write_file(f"{out_dir}/babylm_test_unaffected_sents",
-                       f"{base_name}_unaffected_sents.test", sents)
+    # Find the outputs that are missing or were built from other inputs
+    manifest_filenames = {p: get_manifest_filename(p, babylm_dataset)
+                          for p in perturbation_types}
+    manifests = {p: load_manifest(manifest_filenames[p]) for p in perturbation_types}
+    input_hashes = {file: get_input_hash(file, manifests.values())
+                    for file in babylm_data}
+    options = {"per_sentence_rng": args.workers > 0, "text": args.text}
+    report = new_profile_report(babylm_dataset, dict(options, workers=args.workers))
+
+    all_inputs = hashlib.sha256(
+        "".join(input_hashes[file] for file in babylm_data).encode("utf-8")).hexdigest()
+    build_keys = {file: {} for file in babylm_data}
+    stale_files = {}
+    for perturbation_type in perturbation_types:
+        seed = get_rng_seed(PERTURBATIONS[perturbation_type]['perturbation_function'])
+        # A shared generator carries its state from file to file, so every
+        # file's output depends on all inputs and their order, and files
+        # can only be rebuilt together
+        shared_rng = seed is not None and args.workers == 0
+        for file in babylm_data:
+            build_keys[file][perturbation_type] = get_build_key(
+                all_inputs if shared_rng else input_hashes[file],
+                perturbation_type, options)
+        stale_files[perturbation_type] = [
+            file for file in babylm_data if args.force or not is_up_to_date(
+                manifests[perturbation_type], file, build_keys[file][perturbation_type])]
+        if shared_rng and len(stale_files[perturbation_type]) > 0:
+            stale_files[perturbation_type] = babylm_data
 
-        else:
-            # Train or dev
-            combined = unaffected + affected
-            if babylm_dataset == "dev":
-                new_file = os.path.basename(file).replace(json_ext, ".dev")
-            elif babylm_dataset == "unittest":
-                new_file = os.path.basename(file).replace(json_ext, ".test")
-                new_lines_decoded = [gpt2_tokenizer.decode(
-                    [int(tok) for tok in line.split()]) + "\n" for line in combined]
-                combined = [l for pair in zip(
-                    combined, new_lines_decoded) for l in pair]
-            else:
-                new_file = os.path.basename(file).replace(json_ext, ".train")
+    for file in babylm_data:
+        stale = [p for p in perturbation_types if file in stale_files[p]]
+        if len(stale) == 0:
+            print(f"Skipping {file}: outputs are up to date")
+            continue
 
-            out_dir = f"{BABYLM_DATA_PATH}/babylm_data_perturbed/babylm_{args.perturbation_type}/babylm_{babylm_dataset}"
-            os.makedirs(out_dir, exist_ok=True)
-            write_file(out_dir, new_file, combined)
+        print(f"Processing {file} for {', '.join(stale)}")
+        # Line annotations are streamed one at a time
+        data = read_tagged(file)
+        output_name = file
+        if file.endswith(COLUMNAR_EXT):
+            # Name outputs as if the file were tagged JSON
+            output_name = file[:-len(COLUMNAR_EXT)] + ".json"
+
+        profile = new_profile(len(stale)) if args.profile else None
+        profiles = profile["perturbations"] if profile is not None else [None] * len(stale)
+        results = process_lines(
+            data, get_file_key(output_name), args.workers,
+            [PERTURBATIONS[p] for p in stale], profile)
+
+        # Stream output to shards, separately for each perturbation
+        outputs = [open_outputs(p, babylm_dataset, output_name, args.text)
+                   for p in stale]
+        for line_results in tqdm.tqdm(results):
+            for line_outputs, (affected, unaffected, sents), entry in zip(
+                    outputs, line_results, profiles):
+                timed(entry, "write", write_outputs,
+                      line_outputs, affected, unaffected, sents)
+
+        for perturbation_type, line_outputs, entry in zip(stale, outputs, profiles):
+            paths = timed(entry, "write", close_outputs, line_outputs)
+            manifests[perturbation_type]["outputs"][file] = {
+                "key": build_keys[file][perturbation_type], "paths": paths}
+            save_manifest(manifests[perturbation_type],
+                          manifest_filenames[perturbation_type])
+
+        if profile is not None:
+            add_file_profile(report, file, stale, profile)
+
+    if args.profile:
+        report["wall"] = time.perf_counter() - start
+        print(f"Profile written to {save_profile_report(report)}")
 
 
 
@@ -10,8 +10,27 @@ import tqdm
 import os
 import argparse
 import stanza
+import torch
 import json
 import gc
+import shutil
+import multiprocessing
+import multiprocessing.pool
+import queue
+import threading
+import time
+import hashlib
+import sqlite3
+import copy
+import collections
+
+from utils import PERTURBATIONS, TAGGING_PROFILES, get_tagging_profile, \
+    get_gpt2_alignment
+from tagged_corpus import COLUMNAR_EXT, ColumnarWriter, convert_json_to_columnar
+
+
+BATCH_SIZE = 2000
+STANZA_DIR = '/home/s2678328/.cache/en_stanza/en_stanza'
 
 
 test_all_files = sorted(glob.glob("babylm_data/babylm_*/*"))
@@ -29,13 +48,590 @@ def test_equivalent_lines(original_file, json_file):
     assert (original_data == json_data)
 
 
-def __get_constituency_parse(sent, nlp):
+def __get_sent_annotations(doc, profile):
+    sent_annotations = []
+
+    for sent in doc.sentences:
+        if profile["sent_text"] == "lemma":
+            sent_text = " ".join([word.lemma for word in sent.words if word.lemma is not None])
+        else:
+            sent_text = sent.text
+        sa = {'sent_text': sent_text}
+
+        if profile["word_annotations"]:
+            sa['word_annotations'] = __get_word_annotations(sent)
+
+        sent_annotations.append(sa)
+
+    return sent_annotations
+
+
+def __get_word_annotations(sent):
+    word_annotations = []
+    for token, word in zip(sent.tokens, sent.words):
+        wa = {
+            'id': word.id,
+            'text': word.text,
+            'lemma': word.lemma,
+            'upos': word.upos,
+            'xpos': word.xpos,
+            'feats': word.feats,
+            'start_char': token.start_char,
+            'end_char': token.end_char
+        }
+        word_annotations.append(wa)
+    return word_annotations
+
+
+def __add_gpt2_ids(sent_annotations, profile):
+    # Words are located in the sentence text by the same surface form that
+    # the text was built from
+    surface = 'lemma' if profile["sent_text"] == "lemma" else 'text'
+    for sa in sent_annotations:
+        words = [wa[surface] or "" for wa in sa.get('word_annotations', [])]
+        ids, spans = get_gpt2_alignment(sa['sent_text'], words)
+        sa['gpt2_ids'] = ids
+        if 'word_annotations' in sa:
+            sa['word_token_spans'] = spans
+
+
+def __length_buckets(lines, token_budget):
+    """
+    Group lines by length. Lines are sorted by their number of
+    whitespace-separated words and cut into buckets whose padded size
+    (longest line times number of lines) stays within token_budget. Returns
+    buckets of indices into lines.
+    """
+    order = sorted(range(len(lines)), key=lambda k: len(lines[k].split()))
+    buckets, bucket = [], []
+    for k in order:
+        length = max(1, len(lines[k].split()))
+        if len(bucket) > 0 and length * (len(bucket) + 1) > token_budget:
+            buckets.append(bucket)
+            bucket = []
+        bucket.append(k)
+    if len(bucket) > 0:
+        buckets.append(bucket)
+    return buckets
+
+
+def __infer_batch(batch, i, tagger):
+    # Text batch: Stanza segments the joined lines into sentences
+    if isinstance(batch, str):
+        return tagger["nlp"](batch)
+
+    # Line batch of (line index, line) pairs: each line is its own document.
+    # Lines found in the cache are not tagged again, and every other distinct
+    # line is tagged once, in bulk
+    cached = {}
+    if tagger["cache"] is not None:
+        cached = tagger["cache"].get_many(set(line for _, line in batch))
+        hits = sum(line in cached for _, line in batch)
+        tagger["stats"]["cache_hits"] += hits
+        tagger["stats"]["cache_misses"] += len(batch) - hits
+    lines = list(dict.fromkeys(line for _, line in batch if line not in cached))
+
+    if tagger["token_budget"] is not None:
+        buckets = __length_buckets(lines, tagger["token_budget"])
+    else:
+        buckets = [list(range(len(lines)))]
+
+    docs = {}
+    for bucket in buckets:
+        bucket_docs = tagger["nlp"](
+            [stanza.Document([], text=lines[k]) for k in bucket])
+
+        # Measure padding against the longest sentence in the bucket
+        lengths = [len(sent.words) for doc in bucket_docs for sent in doc.sentences]
+        tagger["stats"]["tokens"] += sum(lengths)
+        tagger["stats"]["padded"] += max(lengths, default=0) * len(lengths)
+
+        for k, doc in zip(bucket, bucket_docs):
+            docs[lines[k]] = doc
+
+    # Keep the original line order
+    return [(line_index, line, cached.get(line), docs.get(line))
+            for line_index, line in batch]
+
+
+def __merge_stats(tagger, stats):
+    with tagger["lock"]:
+        for key in stats:
+            tagger["stats"][key] += stats[key]
+
+
+__fallback_state = {}
+
+
+def __infer_fallback(batch, i):
+    # Runs in a forked worker, so its counts are sent back to the parent.
+    # The worker's copy of the tagger predates the per-file counters
+    start = time.perf_counter()
+    tagger = __fallback_state["tagger"]
+    stats = collections.Counter()
+    tagged = __infer_batch(
+        batch, i, dict(tagger, nlp=tagger["nlp_fallback"], stats=stats))
+    return tagged, stats, time.perf_counter() - start
+
+
+def __infer_or_fallback(batch, i, tagger):
+    """
+    Run inference on the main device and return (device, tagged). If CuDNN
+    fails on the batch, it is handed to the CPU fallback pool and its
+    pending result is returned instead, so the main device can move on to
+    the next batch.
+    Statistics are only counted for the attempt that succeeds.
+    """
+    stats = dict.fromkeys(tagger["stats"], 0)
     try:
-        parse_doc = nlp(sent.text)
-        parse_trees = [str(s.constituency) for s in parse_doc.sentences]
-        return "(ROOT " + " ".join(parse_trees) + ")"
-    except:
-        return None
+        tagged = __infer_batch(batch, i, dict(tagger, stats=stats))
+    except RuntimeError as e:
+        if tagger["fallback_pool"] is None or \
+                'CUDNN_STATUS_NOT_SUPPORTED' not in str(e):
+            raise e
+        print(f"[Warning] CuDNN crash on batch {i} – tagging it on CPU in the background.")
+        return tagger["fallback_pool"].apply_async(__infer_fallback, (batch, i))
+    __merge_stats(tagger, stats)
+    return tagger["device"], tagged
+
+
+def __convert_batch(tagged, tagger):
+    if not isinstance(tagged, list):
+        sent_annotations = __get_sent_annotations(tagged, tagger["profile"])
+        if tagger["gpt2"]:
+            __add_gpt2_ids(sent_annotations, tagger["profile"])
+        if tagger["parse"]:
+            __add_parses(sent_annotations, tagged.sentences, tagger)
+        return sent_annotations
+
+    # Convert each newly tagged line once, and parse all of their sentences
+    # together
+    new_annotations = {}
+    sentences = []
+    for _, line, cached, doc in tagged:
+        if cached is None and line not in new_annotations:
+            new_annotations[line] = __get_sent_annotations(doc, tagger["profile"])
+            sentences.extend(doc.sentences)
+            if tagger["gpt2"]:
+                __add_gpt2_ids(new_annotations[line], tagger["profile"])
+    if tagger["parse"]:
+        __add_parses([sa for sas in new_annotations.values() for sa in sas],
+                     sentences, tagger)
+    if tagger["cache"] is not None and len(new_annotations) > 0:
+        tagger["cache"].put_many(
+            {line: json.dumps(sas) for line, sas in new_annotations.items()})
+
+    # Sentences of a line batch record the line they came from
+    sent_annotations = []
+    seen = set()
+    for line_index, line, cached, doc in tagged:
+        if cached is not None:
+            line_annotations = json.loads(cached)
+        elif line in seen:
+            line_annotations = copy.deepcopy(new_annotations[line])
+        else:
+            line_annotations = new_annotations[line]
+            seen.add(line)
+
+        for sa in line_annotations:
+            sa['line'] = line_index
+            sent_annotations.append(sa)
+
+    return sent_annotations
+
+
+##############################################################################
+# CONSTITUENCY PARSING
+# Parsing is a separate stage over all sentences of a batch. Sentences are
+# parsed from their tagged words in large pretokenized batches, either by a
+# pool of CPU worker processes or by a single (GPU) pipeline, and trees are
+# joined back by position. A failing batch is retried sentence by sentence,
+# and every sentence that still fails records its error.
+##############################################################################
+
+
+PARSE_CHUNK_SIZE = 256
+
+__parse_state = {}
+
+
+def __parse_chunk(word_lists, nlp):
+    """
+    Parse pretokenized sentences in one pipeline call. Returns a
+    (tree, error) pair for every sentence.
+    """
+    try:
+        doc = nlp(word_lists)
+        return [("(ROOT " + str(sent.constituency) + ")", None)
+                for sent in doc.sentences]
+    except Exception as e:
+        if len(word_lists) == 1:
+            return [(None, f"{type(e).__name__}: {e}")]
+
+    results = []
+    for words in word_lists:
+        results.extend(__parse_chunk([words], nlp))
+    return results
+
+
+def __parse_worker(word_lists):
+    return __parse_chunk(word_lists, __parse_state["nlp"])
+
+
+def __add_parses(sent_annotations, sentences, tagger):
+    start = time.perf_counter()
+
+    word_lists = [[word.text for word in sent.words] for sent in sentences]
+    if tagger["parse_pool"] is not None:
+        chunks = [word_lists[k:k + PARSE_CHUNK_SIZE]
+                  for k in range(0, len(word_lists), PARSE_CHUNK_SIZE)]
+        results = [result for chunk_results in
+                   tagger["parse_pool"].map(__parse_worker, chunks)
+                   for result in chunk_results]
+    else:
+        results = __parse_chunk(word_lists, tagger["nlp_parse"]) \
+            if len(word_lists) > 0 else []
+
+    parse_failures = 0
+    for sa, (tree, error) in zip(sent_annotations, results):
+        sa['constituency_parse'] = tree
+        if error is not None:
+            sa['parse_error'] = error
+            parse_failures += 1
+    # The inference thread updates the same stats
+    __merge_stats(tagger, {"parse_failures": parse_failures})
+
+    tagger["timings"]["parse"] += time.perf_counter() - start
+
+
+##############################################################################
+# ANNOTATION CACHE
+# A persistent SQLite table mapping a hash of the tagger configuration and a
+# line's text to the line's sentence annotations. Repeated lines are only
+# tagged once, and the same cache file can be shared by every split.
+##############################################################################
+
+
+class AnnotationCache:
+
+    def __init__(self, path, fingerprint):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.lock = threading.Lock()
+        self.pid = None
+        self.connection = None
+
+    def __connect(self):
+        # Forked shard workers open their own connection
+        if self.pid != os.getpid():
+            self.connection = sqlite3.connect(
+                self.path, timeout=600, check_same_thread=False)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS annotations "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self.connection.commit()
+            self.pid = os.getpid()
+        return self.connection
+
+    def __key(self, line):
+        return hashlib.sha1(
+            (self.fingerprint + "\0" + line).encode("utf-8")).hexdigest()
+
+    def get_many(self, lines):
+        keys = {self.__key(line): line for line in lines}
+        key_list = list(keys)
+        found = {}
+        with self.lock:
+            connection = self.__connect()
+            for k in range(0, len(key_list), 500):
+                chunk = key_list[k:k + 500]
+                rows = connection.execute(
+                    "SELECT key, value FROM annotations WHERE key IN "
+                    f"({','.join('?' * len(chunk))})", chunk)
+                for key, value in rows:
+                    found[keys[key]] = value
+        return found
+
+    def put_many(self, entries):
+        rows = [(self.__key(line), value) for line, value in entries.items()]
+        with self.lock:
+            connection = self.__connect()
+            connection.executemany(
+                "INSERT OR REPLACE INTO annotations VALUES (?, ?)", rows)
+            connection.commit()
+
+
+def __rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def __save_manifest(manifest, manifest_filename):
+    tmp_filename = manifest_filename + ".tmp"
+    with open(tmp_filename, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_filename, manifest_filename)
+
+
+def __writer(outfile, tagged_queue, num_batches, offset, tagger, errors):
+    timings = tagger["timings"]
+    j = 0
+    while True:
+        item = tagged_queue.get()
+        if item is None:
+            return
+
+        # Keep draining after a failure so the producer never blocks
+        if len(errors) > 0:
+            continue
+
+        try:
+            # Batches tagged in the background are waited for here, so the
+            # queue doubles as a reorder buffer that keeps batch order
+            if isinstance(item, multiprocessing.pool.AsyncResult):
+                tagged, stats, seconds = item.get()
+                __merge_stats(tagger, stats)
+                timings["cpu_fallback"] += seconds
+                item = ("cpu", tagged)
+            device, tagged = item
+            del item
+
+            with tagger["lock"]:
+                tagger["stats"][f"{device}_batches"] += 1
+            if tagger["device_log"] is not None:
+                tagger["device_log"].write(
+                    f"{tagger['source']}\t{offset + j}\t{device}\n")
+
+            # Parsing is timed as its own stage
+            start = time.perf_counter()
+            parse_time = timings["parse"]
+            la = {'sent_annotations': __convert_batch(tagged, tagger)}
+            del tagged
+            timings["convert"] += time.perf_counter() - start - \
+                (timings["parse"] - parse_time)
+
+            start = time.perf_counter()
+            if isinstance(outfile, ColumnarWriter):
+                outfile.write_line(la)
+            else:
+                json.dump(la, outfile, indent=4)
+                if j < num_batches - 1:
+                    outfile.write(",\n")
+            del la
+
+            # Record the batch as complete once its bytes are on disk
+            if tagger["manifest"] is not None:
+                manifest, manifest_filename = tagger["manifest"]
+                outfile.flush()
+                os.fsync(outfile.fileno())
+                manifest["batches"].append([offset + j, outfile.tell(), device])
+                __save_manifest(manifest, manifest_filename)
+            timings["write"] += time.perf_counter() - start
+
+            if __rss_mb() > tagger["gc_threshold"]:
+                start = time.perf_counter()
+                gc.collect()
+                timings["gc"] += time.perf_counter() - start
+        except Exception as e:
+            errors.append(e)
+        j += 1
+
+
+def __write_batches(outfile, batches, tagger, offset=0, progress=True):
+    """
+    Tag each batch and write its line annotation to outfile. Inference runs
+    in the calling thread while a writer thread converts tagged documents to
+    annotations and serializes them, with a bounded queue in between. Line
+    annotations are separated by ",\n"; the caller writes the enclosing
+    brackets. offset is the index of the first batch within the whole file.
+    """
+    tagged_queue = queue.Queue(maxsize=tagger["queue_size"])
+    errors = []
+    writer = threading.Thread(
+        target=__writer,
+        args=(outfile, tagged_queue, len(batches), offset, tagger, errors))
+    writer.start()
+
+    try:
+        for j, batch in enumerate(tqdm.tqdm(batches, disable=not progress)):
+            if len(errors) > 0:
+                break
+            start = time.perf_counter()
+            item = __infer_or_fallback(batch, offset + j, tagger)
+            tagger["timings"]["inference"] += time.perf_counter() - start
+            tagged_queue.put(item)
+            del item
+    finally:
+        tagged_queue.put(None)
+        writer.join()
+
+    if len(errors) > 0:
+        raise errors[0]
+
+
+def __report_padding(stats):
+    if stats["padded"] > 0:
+        ratio = 1 - stats["tokens"] / stats["padded"]
+        print(f"Padding ratio: {ratio:.2%} ({stats['tokens']} tokens, "
+              f"{stats['padded']} padded slots)")
+
+
+def __report_devices(stats):
+    print(f"Batches by device: gpu {stats['gpu_batches']}, "
+          f"cpu {stats['cpu_batches']}")
+
+
+def __report_cache(stats):
+    lookups = stats["cache_hits"] + stats["cache_misses"]
+    if lookups > 0:
+        print(f"Cache hit rate: {stats['cache_hits'] / lookups:.2%} "
+              f"({stats['cache_hits']} of {lookups} lines)")
+
+
+def __report_parse_failures(stats):
+    if stats["parse_failures"] > 0:
+        print(f"[Warning] {stats['parse_failures']} sentences could not be "
+              "parsed; see their parse_error field.")
+
+
+def __report_timings(timings, wall):
+    # Stages overlap, so their shares of the wall-clock time can add up to
+    # more than 100%
+    print(f"Wall-clock time: {wall:.1f}s")
+    for stage, seconds in timings.items():
+        share = seconds / wall if wall > 0 else 0
+        print(f"  {stage}: {seconds:.1f}s ({share:.1%})")
+
+
+##############################################################################
+# RESUMABLE TAGGING
+# JSON output is written to a .partial file next to a .manifest that lists
+# each completed batch with the byte offset where it ends. A restarted run
+# with the same input and options truncates the partial file to the last
+# completed batch, skips the finished batches, and appends the rest. The
+# finished file is moved into place atomically.
+##############################################################################
+
+
+def tag_resumable(batches, json_filename, tagger, key):
+    partial_filename = json_filename + ".partial"
+    manifest_filename = json_filename + ".manifest"
+
+    manifest = None
+    if os.path.exists(manifest_filename) and os.path.exists(partial_filename):
+        with open(manifest_filename) as f:
+            manifest = json.load(f)
+        if manifest["key"] != key or manifest["num_batches"] != len(batches):
+            print(f"[Warning] {manifest_filename} does not match this run – starting over.")
+            manifest = None
+
+    if manifest is None:
+        manifest = {"key": key, "num_batches": len(batches), "batches": []}
+        with open(partial_filename, "w") as outfile:
+            outfile.write("[\n")
+        __save_manifest(manifest, manifest_filename)
+
+    done = len(manifest["batches"])
+    if done > 0:
+        print(f"Resuming after {done} of {len(batches)} batches")
+        end = manifest["batches"][-1][1]
+    else:
+        end = len("[\n")
+
+    # Drop anything written after the last completed batch
+    with open(partial_filename, "r+b") as f:
+        f.truncate(end)
+
+    with open(partial_filename, "a") as outfile:
+        tagger["manifest"] = (manifest, manifest_filename)
+        try:
+            __write_batches(outfile, batches[done:], tagger, offset=done)
+        finally:
+            tagger["manifest"] = None
+        if len(batches) > 0:
+            outfile.write("\n")
+        outfile.write("]\n")
+        outfile.flush()
+        os.fsync(outfile.fileno())
+
+    os.replace(partial_filename, json_filename)
+    os.remove(manifest_filename)
+
+
+##############################################################################
+# SHARDED TAGGING
+# Batches of a file are split into contiguous ranges, one per worker process.
+# Pipelines are loaded in the parent before the workers are forked, so model
+# weights are shared copy-on-write and every worker owns its own pipeline
+# object. Shards are merged in batch order, which makes the output identical
+# to a single-process run.
+##############################################################################
+
+
+__shard_state = {}
+
+
+def __init_shard_worker(num_workers):
+    # Avoid oversubscribing cores with each worker's intra-op threads
+    torch.set_num_threads(max(1, os.cpu_count() // num_workers))
+
+
+def __tag_shard(shard):
+    start, end, shard_filename = shard
+    # A worker may tag several shards, so each reports only its own counts
+    tagger = __shard_state["tagger"]
+    tagger = dict(tagger, stats=dict.fromkeys(tagger["stats"], 0),
+                  timings=dict.fromkeys(tagger["timings"], 0))
+    with open(shard_filename, "w") as outfile:
+        __write_batches(outfile, __shard_state["batches"][start:end], tagger,
+                        offset=start, progress=False)
+    if tagger["device_log"] is not None:
+        tagger["device_log"].flush()
+    return shard_filename, tagger["stats"], tagger["timings"]
+
+
+def __merge_shards(shard_filenames, json_filename):
+    with open(json_filename, "w") as outfile:
+        outfile.write("[\n")
+        for k, shard_filename in enumerate(shard_filenames):
+            with open(shard_filename) as infile:
+                shutil.copyfileobj(infile, outfile)
+            outfile.write(",\n" if k < len(shard_filenames) - 1 else "\n")
+            os.remove(shard_filename)
+        outfile.write("]\n")
+
+
+def tag_sharded(batches, json_filename, num_workers, tagger):
+    # Workers have no GPU, so there is nothing to fall back from
+    __shard_state.update(
+        batches=batches, tagger=dict(tagger, nlp_fallback=None,
+                                     fallback_pool=None, device="cpu"))
+
+    # Contiguous batch ranges, so merging in shard order keeps line order
+    n = len(batches)
+    bounds = [n * k // num_workers for k in range(num_workers + 1)]
+    shards = [(bounds[k], bounds[k+1], f"{json_filename}.shard{k}")
+              for k in range(num_workers) if bounds[k] < bounds[k+1]]
+
+    # Workers append to the same device log, so nothing may be left buffered
+    # in the parent when they are forked
+    if tagger["device_log"] is not None:
+        tagger["device_log"].flush()
+
+    shard_filenames = []
+    if len(shards) > 0:
+        ctx = multiprocessing.get_context("fork")
+        with ctx.Pool(len(shards), initializer=__init_shard_worker,
+                      initargs=(len(shards),)) as pool:
+            for shard_filename, stats, timings in tqdm.tqdm(
+                    pool.imap(__tag_shard, shards), total=len(shards)):
+                shard_filenames.append(shard_filename)
+                __merge_stats(tagger, stats)
+                for key in timings:
+                    tagger["timings"][key] += timings[key]
+
+    __merge_shards(shard_filenames, json_filename)
+    __shard_state.clear()
 
 
 if __name__ == "__main__":
@@ -49,9 +645,68 @@ if __name__ == "__main__":
                         nargs='+', help="Path to file(s)")
     parser.add_argument('-p', '--parse', action='store_true',
                         help="Include constituency parse")
+    parser.add_argument('--parse-workers', type=int, default=0,
+                        help="Number of CPU processes for constituency "
+                        "parsing; with 0, parse in batches on the GPU")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="Number of worker processes; with more than one, "
+                        "each file is split by line range into shards tagged "
+                        "on CPU by forked workers sharing the loaded weights. "
+                        "CPU and GPU pipelines may annotate a few sentences "
+                        "differently, and sharded runs cannot be resumed")
+    parser.add_argument('-l', '--lines', action='store_true',
+                        help="Keep BabyLM line boundaries: feed each line as a "
+                        "pre-split document instead of re-running sentence "
+                        "splitting, and record each sentence's source line")
+    parser.add_argument('--perturbation', choices=PERTURBATIONS.keys(),
+                        help="Only run the processors and store the "
+                        "annotations that this perturbation needs")
+    parser.add_argument('--token-budget', type=int, default=None,
+                        help="With --lines, group lines of similar length "
+                        "into sub-batches of at most this many padded words")
+    parser.add_argument('--queue-size', type=int, default=4,
+                        help="Number of tagged batches buffered between "
+                        "inference and the writer thread")
+    parser.add_argument('--gc-threshold', type=float, default=8192,
+                        help="Only force garbage collection once resident "
+                        "memory exceeds this many MB")
+    parser.add_argument('--format', choices=['json', 'columnar'], default='json',
+                        help="Output format; columnar writes a directory of "
+                        "flat arrays that can be read with tagged_corpus.py")
+    parser.add_argument('--cache', default=None,
+                        help="With --lines, SQLite file caching annotations "
+                        "of lines that were already tagged; may be shared "
+                        "across splits")
+    parser.add_argument('--gpt2', action='store_true',
+                        help="Store base GPT-2 token ids of each sentence and "
+                        "the token span of each word, so perturbations do "
+                        "not need to tokenize the text again")
+    parser.add_argument('--cpu-workers', type=int, default=None,
+                        help="Number of CPU processes that re-tag batches "
+                        "after a CuDNN failure, each with its own copy of "
+                        "the CPU pipeline; batches are still written in "
+                        "order, and up to --queue-size batches are "
+                        "buffered meanwhile. With 0, a CuDNN failure stops "
+                        "the run (default: 1)")
+    parser.add_argument('--device-log', default=None,
+                        help="Append the device that tagged each batch to "
+                        "this file")
 
     args = parser.parse_args()
 
+    if args.cache is not None and not args.lines:
+        parser.error("--cache requires --lines")
+    # Sharded workers tag and parse on CPU themselves
+    if args.workers > 1 and args.parse_workers > 0:
+        parser.error("--parse-workers cannot be combined with --workers")
+    if args.workers > 1 and args.cpu_workers is not None:
+        parser.error("--cpu-workers cannot be combined with --workers")
+    if args.cpu_workers is None:
+        args.cpu_workers = 1
+    if args.workers > 1 and args.format == 'json':
+        print("[Warning] Sharded runs cannot be resumed – an interrupted "
+              "file is tagged again from the start.")
+
     # nlp1 = stanza.Pipeline(
     #     lang=  'zh-hans', #'zh',
     #     processors='tokenize,pos,lemma',
@@ -60,94 +715,157 @@ if __name__ == "__main__":
     #     use_gpu=True
     # )
 
-    nlp1 = stanza.Pipeline(
-    lang='en',
-    processors='tokenize,pos,lemma',
-    package=None,  # Let it use what's locally available
-    dir='/home/s2678328/.cache/en_stanza/en_stanza',
-    use_gpu=True,
-    allow_download=False  # Optional: prevent fallback to HuggingFace
-)
+    profile_name = "default"
+    if args.perturbation is not None:
+        profile_name = get_tagging_profile(args.perturbation)
+        print(f"Tagging profile for {args.perturbation}: {profile_name}")
+    profile = TAGGING_PROFILES[profile_name]
+
+    pipeline_kwargs = {'tokenize_no_ssplit': True} if args.lines else {}
+
+    # CUDA cannot be shared with forked workers, so sharded runs only load
+    # the CPU pipeline
+    nlp1 = None
+    if args.workers <= 1:
+        nlp1 = stanza.Pipeline(
+        lang='en',
+        processors=profile["processors"],
+        package=None,  # Let it use what's locally available
+        dir=STANZA_DIR,
+        use_gpu=True,
+        allow_download=False,  # Optional: prevent fallback to HuggingFace
+        **pipeline_kwargs
+    )
 
 
     nlp_cpu = stanza.Pipeline(
         lang= 'en',  # 'zh',
-        processors='tokenize,pos,lemma',
+        processors=profile["processors"],
         package=None, #"default_accurate",
-        dir='/home/s2678328/.cache/en_stanza/en_stanza',
-        use_gpu=False
+        dir=STANZA_DIR,
+        use_gpu=False,
+        **pipeline_kwargs
     )
 
+    # Forked workers (shards or parse workers) can only parse on CPU
+    nlp_parse = None
+    parse_pool = None
     if args.parse:
-        print("[Warning] Constituency parsing is not supported for Russian. Disabling.")
-        args.parse = False
-
-    BATCH_SIZE = 2000
+        nlp_parse = stanza.Pipeline(
+            lang='en',
+            processors='tokenize,pos,constituency',
+            package=None,
+            dir=STANZA_DIR,
+            tokenize_pretokenized=True,
+            use_gpu=args.workers <= 1 and args.parse_workers == 0,
+        )
+        if args.workers <= 1 and args.parse_workers > 0:
+            __parse_state["nlp"] = nlp_parse
+            parse_pool = multiprocessing.get_context("fork").Pool(
+                args.parse_workers, initializer=__init_shard_worker,
+                initargs=(args.parse_workers,))
+
+    tagger = {
+        'nlp': nlp1,
+        'nlp_fallback': nlp_cpu,
+        'parse': args.parse,
+        'nlp_parse': nlp_parse,
+        'parse_pool': parse_pool,
+        'profile': profile,
+        'token_budget': args.token_budget,
+        'queue_size': args.queue_size,
+        'gc_threshold': args.gc_threshold,
+        'manifest': None,
+        'cache': None,
+        'gpt2': args.gpt2,
+        'device': 'gpu',
+        'fallback_pool': None,
+        'device_log': open(args.device_log, "a") if args.device_log else None,
+        'lock': threading.Lock(),
+    }
+
+    if args.cache is not None:
+        # Annotations are only reused by the same tagger configuration
+        fingerprint = json.dumps({
+            'profile': profile,
+            'parse': args.parse,
+            'gpt2': args.gpt2,
+            'stanza': stanza.__version__,
+            'dir': STANZA_DIR,
+        }, sort_keys=True)
+        tagger['cache'] = AnnotationCache(args.cache, fingerprint)
+
+    # Stanza pipelines are not thread-safe, so each fallback worker is a
+    # forked process with its own copy of the CPU pipeline. The pool is
+    # forked before any thread is started
+    if args.workers <= 1 and args.cpu_workers > 0:
+        __fallback_state["tagger"] = tagger
+        tagger['fallback_pool'] = multiprocessing.get_context("fork").Pool(
+            args.cpu_workers, initializer=__init_shard_worker,
+            initargs=(args.cpu_workers,))
 
     for file in args.path:
         print(f"Processing: {file.name}")
         lines = [l.strip() for l in file.readlines()]
-        line_batches = [lines[i:i + BATCH_SIZE] for i in range(0, len(lines), BATCH_SIZE)]
-        text_batches = [" ".join(batch) for batch in line_batches]
+        if args.lines:
+            numbered = [(i, l) for i, l in enumerate(lines) if l]
+            batches = [numbered[i:i + BATCH_SIZE] for i in range(0, len(numbered), BATCH_SIZE)]
+        else:
+            line_batches = [lines[i:i + BATCH_SIZE] for i in range(0, len(lines), BATCH_SIZE)]
+            batches = [" ".join(batch) for batch in line_batches]
 
         ext = '_parsed.json' if args.parse else '.json'
         json_filename = os.path.splitext(file.name)[0] + ext
-        print(f"Writing to: {json_filename}")
-
-        with open(json_filename, "w") as outfile:
-            outfile.write("[\n")
-
-            for i, text in enumerate(tqdm.tqdm(text_batches)):
-                try:
-                    doc = nlp1(text)
-                except RuntimeError as e:
-                    if 'CUDNN_STATUS_NOT_SUPPORTED' in str(e):
-                        print(f"[Warning] CuDNN crash on batch {i} – retrying on CPU.")
-                        doc = nlp_cpu(text)
-                    else:
-                        raise e
-
-                sent_annotations = []
-
-                for sent in doc.sentences:
-                    word_annotations = []
-                    for token, word in zip(sent.tokens, sent.words):
-                        wa = {
-                            'id': word.id,
-                            'text': word.text,
-                            'lemma': word.lemma,
-                            'upos': word.upos,
-                            'xpos': word.xpos,
-                            'feats': word.feats,
-                            'start_char': token.start_char,
-                            'end_char': token.end_char
-                        }
-                        word_annotations.append(wa)
-
-                    sa = {
-                        # 'sent_text': sent.text,
-                        'sent_text':" ".join([word.lemma for word in sent.words if word.lemma is not None]),
-
-                        'word_annotations': word_annotations
-                    }
-
-                    if args.parse:
-                        sa['constituency_parse'] = __get_constituency_parse(sent, nlp_cpu)
-
-                    sent_annotations.append(sa)
-
-                la = {'sent_annotations': sent_annotations}
-                json.dump(la, outfile, indent=4)
-
-                if i < len(text_batches) - 1:
-                    outfile.write(",\n")
-                else:
-                    outfile.write("\n")
-
-                del doc, sent_annotations, la
-                gc.collect()
+        columnar_path = os.path.splitext(json_filename)[0] + COLUMNAR_EXT
+        print(f"Writing to: {columnar_path if args.format == 'columnar' else json_filename}")
+
+        tagger['source'] = file.name
+        tagger['stats'] = {'tokens': 0, 'padded': 0, 'cache_hits': 0,
+                           'cache_misses': 0, 'parse_failures': 0,
+                           'gpu_batches': 0, 'cpu_batches': 0}
+        tagger['timings'] = {'inference': 0, 'cpu_fallback': 0, 'convert': 0,
+                             'parse': 0, 'write': 0, 'gc': 0}
+        start = time.perf_counter()
+
+        if args.workers > 1:
+            tag_sharded(batches, json_filename, args.workers,
+                        dict(tagger, nlp=nlp_cpu))
+            if args.format == 'columnar':
+                convert_json_to_columnar(json_filename, columnar_path)
+                os.remove(json_filename)
+        elif args.format == 'columnar':
+            with ColumnarWriter(columnar_path) as outfile:
+                __write_batches(outfile, batches, tagger)
+        else:
+            # Resume only a run over the same input with the same options.
+            # The input is identified by the lines it tags, so an edit that
+            # keeps its size is not mistaken for the same input
+            key = {
+                'source_hash': hashlib.sha256(
+                    "\n".join(lines).encode("utf-8")).hexdigest(),
+                'profile': profile_name,
+                'lines': args.lines,
+                'parse': args.parse,
+                'gpt2': args.gpt2,
+                'batch_size': BATCH_SIZE,
+            }
+            tag_resumable(batches, json_filename, tagger, key)
+
+        __report_devices(tagger['stats'])
+        __report_padding(tagger['stats'])
+        __report_cache(tagger['stats'])
+        __report_parse_failures(tagger['stats'])
+        __report_timings(tagger['timings'], time.perf_counter() - start)
+
+    if parse_pool is not None:
+        parse_pool.close()
+        parse_pool.join()
+    if tagger['fallback_pool'] is not None:
+        tagger['fallback_pool'].close()
+        tagger['fallback_pool'].join()
+    if tagger['device_log'] is not None:
+        tagger['device_log'].close()
 
-            outfile.write("]\n")
 
 # if __name__ == "__main__":
 
@@ -0,0 +1,390 @@
+# tagged_corpus.py
+# Compact columnar storage for tagged BabyLM files
+
+import os
+import json
+import argparse
+from glob import glob
+import numpy as np
+
+
+COLUMNAR_EXT = ".columnar"
+
+# Word-level string columns that are interned into small integer codes
+CATEGORICAL_COLUMNS = ["upos", "xpos", "feats"]
+
+# Fixed-width columns and their on-disk dtypes (little-endian)
+COLUMN_DTYPES = {
+    "line_ends": "<i8",
+    "sent_word_ends": "<i8",
+    "sent_line": "<i8",
+    "sent_text_ends": "<i8",
+    "parse_ends": "<i8",
+    "parse_null": "u1",
+    "parse_error_ends": "<i8",
+    "parse_error_null": "u1",
+    "word_id": "<i4",
+    "word_text_ends": "<i8",
+    "word_lemma_ends": "<i8",
+    "word_lemma_null": "u1",
+    "upos": "<i2",
+    "xpos": "<i2",
+    "feats": "<i2",
+    "start_char": "<i4",
+    "end_char": "<i4",
+    "gpt2_ids": "<u2",
+    "gpt2_ids_ends": "<i8",
+    "word_token_start": "<i4",
+    "word_token_end": "<i4",
+}
+
+# Variable-width UTF-8 string columns, indexed by the matching *_ends column
+BLOB_COLUMNS = ["sent_text", "parse", "parse_error", "word_text", "word_lemma"]
+
+
+##############################################################################
+# WRITER
+# A tagged file is stored as a directory of flat little-endian arrays plus a
+# meta.json holding the interned vocabularies. Lines, sentences and words
+# are linked by cumulative end offsets, so columns can be appended to one
+# line annotation at a time.
+##############################################################################
+
+
+class ColumnarWriter:
+
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.files = {name: open(os.path.join(path, name + ".bin"), "wb")
+                      for name in list(COLUMN_DTYPES) + BLOB_COLUMNS}
+        self.vocabs = {name: {} for name in CATEGORICAL_COLUMNS}
+        self.counts = {"lines": 0, "sents": 0, "words": 0,
+                       "sent_text": 0, "parse": 0, "parse_error": 0, "word_text": 0,
+                       "word_lemma": 0, "gpt2_ids": 0}
+        self.fields = {"word_annotations": False, "constituency_parse": False,
+                       "parse_error": False, "line": False, "gpt2_ids": False,
+                       "word_token_spans": False}
+
+    def __code(self, column, value):
+        if value is None:
+            return -1
+        vocab = self.vocabs[column]
+        if value not in vocab:
+            if len(vocab) >= np.iinfo(np.int16).max:
+                raise ValueError(f"Too many distinct values for {column}")
+            vocab[value] = len(vocab)
+        return vocab[value]
+
+    def __write_array(self, name, values):
+        np.asarray(values, dtype=COLUMN_DTYPES[name]).tofile(self.files[name])
+
+    def __write_strings(self, name, strings):
+        ends = []
+        for s in strings:
+            data = s.encode("utf-8")
+            self.files[name].write(data)
+            self.counts[name] += len(data)
+            ends.append(self.counts[name])
+        self.__write_array(name + "_ends", ends)
+
+    def write_line(self, la):
+        sents = la["sent_annotations"]
+        words = [wa for sa in sents for wa in sa.get("word_annotations", [])]
+
+        for sa in sents:
+            self.fields["word_annotations"] |= "word_annotations" in sa
+            self.fields["constituency_parse"] |= "constituency_parse" in sa
+            self.fields["parse_error"] |= "parse_error" in sa
+            self.fields["line"] |= "line" in sa
+            self.fields["gpt2_ids"] |= "gpt2_ids" in sa
+            self.fields["word_token_spans"] |= "word_token_spans" in sa
+
+        # Sentence columns
+        self.counts["sents"] += len(sents)
+        self.__write_array("line_ends", [self.counts["sents"]])
+        sent_word_ends = []
+        for sa in sents:
+            self.counts["words"] += len(sa.get("word_annotations", []))
+            sent_word_ends.append(self.counts["words"])
+        self.__write_array("sent_word_ends", sent_word_ends)
+        self.__write_array("sent_line", [sa.get("line", -1) for sa in sents])
+        self.__write_strings("sent_text", [sa["sent_text"] for sa in sents])
+        parses = [sa.get("constituency_parse") for sa in sents]
+        self.__write_strings("parse", [p or "" for p in parses])
+        self.__write_array("parse_null", [p is None for p in parses])
+        errors = [sa.get("parse_error") for sa in sents]
+        self.__write_strings("parse_error", [e or "" for e in errors])
+        self.__write_array("parse_error_null", [e is None for e in errors])
+        gpt2_ids_ends = []
+        for sa in sents:
+            ids = sa.get("gpt2_ids", [])
+            self.__write_array("gpt2_ids", ids)
+            self.counts["gpt2_ids"] += len(ids)
+            gpt2_ids_ends.append(self.counts["gpt2_ids"])
+        self.__write_array("gpt2_ids_ends", gpt2_ids_ends)
+
+        # Word columns
+        self.__write_array("word_id", [wa["id"] for wa in words])
+        self.__write_strings("word_text", [wa["text"] for wa in words])
+        self.__write_strings("word_lemma", [wa["lemma"] or "" for wa in words])
+        self.__write_array("word_lemma_null", [wa["lemma"] is None for wa in words])
+        for column in CATEGORICAL_COLUMNS:
+            self.__write_array(column, [self.__code(column, wa[column]) for wa in words])
+        self.__write_array("start_char", [wa["start_char"] for wa in words])
+        self.__write_array("end_char", [wa["end_char"] for wa in words])
+        spans = [span for sa in sents for span in sa.get(
+            "word_token_spans", [[-1, -1]] * len(sa.get("word_annotations", [])))]
+        self.__write_array("word_token_start", [start for start, _ in spans])
+        self.__write_array("word_token_end", [end for _, end in spans])
+
+        self.counts["lines"] += 1
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        meta = {
+            "counts": self.counts,
+            "fields": self.fields,
+            "vocabs": {column: sorted(vocab, key=vocab.get)
+                       for column, vocab in self.vocabs.items()},
+        }
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=4)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+##############################################################################
+# READER
+##############################################################################
+
+
+def __load_column(path, name, dtype):
+    filename = os.path.join(path, name + ".bin")
+    # Files written before a column was added do not have it
+    if not os.path.exists(filename) or os.path.getsize(filename) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode="r")
+
+
+def __get_string(blob, ends, i):
+    start = ends[i-1] if i > 0 else 0
+    return bytes(blob[start:ends[i]]).decode("utf-8")
+
+
+def read_columnar(path):
+    """
+    Yield the line annotations of a columnar tagged file one at a time, as
+    the same {"sent_annotations": [...]} dicts that tag.py writes to JSON.
+    """
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    fields = meta["fields"]
+    vocabs = meta["vocabs"]
+
+    col = {name: __load_column(path, name, dtype)
+           for name, dtype in COLUMN_DTYPES.items()}
+    blob = {name: __load_column(path, name, "u1") for name in BLOB_COLUMNS}
+
+    def category(column, w):
+        code = int(col[column][w])
+        return None if code < 0 else vocabs[column][code]
+
+    sent_start = 0
+    for line_end in col["line_ends"]:
+        sent_annotations = []
+        for s in range(sent_start, int(line_end)):
+            sa = {'sent_text': __get_string(blob["sent_text"], col["sent_text_ends"], s)}
+            word_start = int(col["sent_word_ends"][s-1]) if s > 0 else 0
+            word_end = int(col["sent_word_ends"][s])
+
+            if fields["word_annotations"]:
+                word_annotations = []
+                for w in range(word_start, word_end):
+                    lemma = None
+                    if not col["word_lemma_null"][w]:
+                        lemma = __get_string(blob["word_lemma"], col["word_lemma_ends"], w)
+                    word_annotations.append({
+                        'id': int(col["word_id"][w]),
+                        'text': __get_string(blob["word_text"], col["word_text_ends"], w),
+                        'lemma': lemma,
+                        'upos': category("upos", w),
+                        'xpos': category("xpos", w),
+                        'feats': category("feats", w),
+                        'start_char': int(col["start_char"][w]),
+                        'end_char': int(col["end_char"][w]),
+                    })
+                sa['word_annotations'] = word_annotations
+
+            if fields["constituency_parse"]:
+                sa['constituency_parse'] = None if col["parse_null"][s] else \
+                    __get_string(blob["parse"], col["parse_ends"], s)
+
+            if fields.get("parse_error", False) and not col["parse_error_null"][s]:
+                sa['parse_error'] = __get_string(
+                    blob["parse_error"], col["parse_error_ends"], s)
+
+            if fields["line"]:
+                sa['line'] = int(col["sent_line"][s])
+
+            if fields["gpt2_ids"]:
+                ids_start = int(col["gpt2_ids_ends"][s-1]) if s > 0 else 0
+                sa['gpt2_ids'] = col["gpt2_ids"][ids_start:int(col["gpt2_ids_ends"][s])].tolist()
+
+            if fields["word_token_spans"]:
+                sa['word_token_spans'] = [
+                    [int(col["word_token_start"][w]), int(col["word_token_end"][w])]
+                    for w in range(word_start, word_end)]
+
+            sent_annotations.append(sa)
+
+        yield {'sent_annotations': sent_annotations}
+        sent_start = int(line_end)
+
+
+##############################################################################
+# STREAMING JSON READER
+# Tagged JSON files are a single top-level array of line annotations. The
+# reader decodes one element at a time from a growing text buffer, so memory
+# is bounded by the largest line annotation rather than by the file.
+##############################################################################
+
+
+JSON_CHUNK_SIZE = 1 << 20
+
+__json_decoder = json.JSONDecoder()
+
+
+def read_json(json_filename, chunk_size=JSON_CHUNK_SIZE):
+    """
+    Yield the elements of a tagged JSON file (as written by tag.py, with or
+    without --parse) one at a time, without loading the whole array.
+    """
+    with open(json_filename) as f:
+        buffer = ""
+        pos = 0
+        eof = False
+        started = False
+        # Only retry decoding once at least this much text has been read, so
+        # a large element is not re-scanned after every chunk
+        needed = 0
+
+        while True:
+            # Skip whitespace, the opening bracket and separators
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,[":
+                if buffer[pos] == "[":
+                    if started:
+                        break
+                    started = True
+                pos += 1
+
+            if pos < len(buffer) and buffer[pos] == "]":
+                return
+
+            if pos < len(buffer) and (eof or len(buffer) - pos >= needed):
+                if not started:
+                    raise ValueError(f"{json_filename} is not a JSON array")
+                try:
+                    element, end = __json_decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    needed = 2 * (len(buffer) - pos)
+                else:
+                    yield element
+                    pos = end
+                    needed = 0
+                    continue
+
+            if eof:
+                raise ValueError(f"{json_filename} ended before the array was closed")
+
+            chunk = f.read(chunk_size)
+            eof = len(chunk) == 0
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+
+def read_tagged(filename):
+    """
+    Yield the line annotations of a tagged file in either format.
+    """
+    if filename.endswith(COLUMNAR_EXT):
+        return read_columnar(filename)
+    return read_json(filename)
+
+
+def list_tagged_files(directory):
+    """
+    Sorted tagged files of a directory. A JSON file converted to the
+    columnar format is listed once, as its columnar file.
+    """
+    files = glob(os.path.join(directory, f"*{COLUMNAR_EXT}"))
+    converted = {os.path.splitext(filename)[0] for filename in files}
+    files += [filename for filename in glob(os.path.join(directory, "*.json"))
+              if os.path.splitext(filename)[0] not in converted]
+    return sorted(files)
+
+
+def test_list_tagged_files(tmp_path):
+    for name in ["a_parsed.json", "a_parsed" + COLUMNAR_EXT, "b_parsed.json",
+                 "c_parsed" + COLUMNAR_EXT]:
+        (tmp_path / name).write_text("")
+    assert [os.path.basename(f) for f in list_tagged_files(str(tmp_path))] == \
+        ["a_parsed" + COLUMNAR_EXT, "b_parsed.json", "c_parsed" + COLUMNAR_EXT]
+
+
+def test_columnar_round_trip(tmp_path):
+    word = {'id': 1, 'text': "Hi", 'lemma': None, 'upos': "INTJ", 'xpos': "UH",
+            'feats': None, 'start_char': 0, 'end_char': 2}
+    data = [{'sent_annotations': [
+        {'sent_text': "Hi", 'word_annotations': [word], 'constituency_parse': "(ROOT (INTJ Hi))"},
+        {'sent_text': "Hi", 'word_annotations': [word], 'constituency_parse': None,
+         'parse_error': "ValueError('no parse')"}]}]
+    path = str(tmp_path / f"x{COLUMNAR_EXT}")
+    with ColumnarWriter(path) as writer:
+        for la in data:
+            writer.write_line(la)
+    assert list(read_columnar(path)) == data
+
+
+def test_read_json(tmp_path):
+    data = [{'sent_annotations': [{'sent_text': f"line {i} ]}} \"x\", ["}]}
+            for i in range(50)]
+
+    # tag.py's incremental layout and a compact single-line array
+    layouts = ["[\n" + ",\n".join(json.dumps(la, indent=4) for la in data) + "\n]\n",
+               json.dumps(data), "[]"]
+    for k, text in enumerate(layouts):
+        filename = tmp_path / f"{k}.json"
+        filename.write_text(text)
+        expected = json.loads(text)
+        assert list(read_json(str(filename), chunk_size=7)) == expected
+        assert list(read_json(str(filename))) == expected
+
+
+def convert_json_to_columnar(json_filename, path):
+    with ColumnarWriter(path) as writer:
+        for la in read_json(json_filename):
+            writer.write_line(la)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        prog='Convert tagged BabyLM files',
+        description='Convert tagged JSON files written by tag.py to the '
+        'columnar format')
+    parser.add_argument('path', nargs='+', help="Path to JSON file(s)")
+
+    args = parser.parse_args()
+
+    for json_filename in args.path:
+        path = os.path.splitext(json_filename)[0] + COLUMNAR_EXT
+        print(f"Converting {json_filename} to {path}")
+        convert_json_to_columnar(json_filename, path)
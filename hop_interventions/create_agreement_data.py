@@ -6,9 +6,9 @@ import sys
 sys.path.append("..")
 
 import pandas as pd
-from glob import glob
 import re
-from utils import gpt2_hop_tokenizer, BABYLM_DATA_PATH, marker_sg_token
+from utils import gpt2_hop_tokenizer, BABYLM_DATA_PATH, marker_sg_token, \
+    list_token_files, read_token_sequences
 from pluralizer import Pluralizer
 
 
@@ -23,9 +23,9 @@ if __name__ == "__main__":
 
     # Get test file paths
     test_file_path = f'{BABYLM_DATA_PATH}/babylm_data_perturbed/' + \
-        'babylm_hop_{}/babylm_test_affected/*'
-    control_files = sorted(glob(test_file_path.format("control")))
-    words4_files = sorted(glob(test_file_path.format("words4")))
+        'babylm_hop_{}/babylm_test_affected/'
+    control_files = list_token_files(test_file_path.format("control"))
+    words4_files = list_token_files(test_file_path.format("words4"))
 
     # Iterate over files and get candidate sequences for interventions
     candidate_sequences = []
@@ -35,8 +35,10 @@ if __name__ == "__main__":
             "/")[-1] == words4_file_path.split("/")[-1]
 
         # Iterate over pairs of lines in file (control and words4)
-        control_lines = open(control_file_path, 'r').readlines()
-        words4_lines = open(words4_file_path, 'r').readlines()
+        control_lines = [" ".join(str(tok) for tok in tokens)
+                         for tokens in read_token_sequences(control_file_path)]
+        words4_lines = [" ".join(str(tok) for tok in tokens)
+                        for tokens in read_token_sequences(words4_file_path)]
         for cl, wl in zip(control_lines, words4_lines):
 
             # Find all matches to patterns
@@ -14,10 +14,10 @@ from numpy.random import default_rng
 from transformers import GPT2LMHeadModel
 from gpt2_no_positional_encoding_model import GPT2NoPositionalEncodingLMHeadModel
 from itertools import zip_longest
-from glob import glob
 from utils import CHECKPOINT_READ_PATH, PERTURBATIONS, PAREN_MODELS, \
     BABYLM_DATA_PATH, gpt2_hop_tokenizer, \
-    marker_sg_token, marker_pl_token, compute_surprisals
+    marker_sg_token, marker_pl_token, compute_surprisals, \
+    list_token_files, read_token_sequences
 
 
 MAX_TRAINING_STEPS = 3000
@@ -63,8 +63,8 @@ if __name__ == "__main__":
     model_path = f"{CHECKPOINT_READ_PATH}/babylm_{args.perturbation_type}_{args.train_set}_{args.paren_model}{no_pos_encodings_underscore}/{model}/runs/{model}/checkpoint-"
 
     # Get perturbed test files
-    test_files = sorted(glob(BABYLM_DATA_PATH +
-        "/babylm_data_perturbed/babylm_{}/babylm_test_affected/*".format(args.perturbation_type)))
+    test_files = list_token_files(BABYLM_DATA_PATH +
+        "/babylm_data_perturbed/babylm_{}/babylm_test_affected".format(args.perturbation_type))
 
     EOS_TOKEN = gpt2_hop_tokenizer.eos_token_id
     FILE_SAMPLE_SIZE = 1000
@@ -81,9 +81,8 @@ if __name__ == "__main__":
         print(test_file)
 
         # Get tokens from test file (+ eos token), and subsample
-        f = open(test_file, 'r')
         file_token_sequences = [
-            [int(s) for s in l.split()] + [EOS_TOKEN] for l in f.readlines()]
+            toks + [EOS_TOKEN] for toks in read_token_sequences(test_file)]
         file_token_sequences = [
             toks for toks in file_token_sequences if len(toks) < MAX_SEQ_LEN]
         sample_indices = rng.choice(
@@ -8,9 +8,8 @@ sys.path.append("..")
 from transformers import GPT2LMHeadModel
 from gpt2_no_positional_encoding_model import GPT2NoPositionalEncodingLMHeadModel
 from utils import CHECKPOINT_READ_PATH, PERTURBATIONS, BABYLM_DATA_PATH, \
-    PAREN_MODELS, gpt2_original_tokenizer
+    PAREN_MODELS, gpt2_original_tokenizer, list_token_files, read_token_sequences
 from tqdm import tqdm
-from glob import glob
 from numpy.random import default_rng
 import pandas as pd
 import torch
@@ -116,8 +115,8 @@ if __name__ == "__main__":
     model_path = f"{CHECKPOINT_READ_PATH}/babylm_{args.perturbation_type}_{args.train_set}_{args.paren_model}{no_pos_encodings_underscore}/{model}/runs/{model}/checkpoint-"
 
     # Get perturbed test files
-    test_files = sorted(glob(
-        f"{BABYLM_DATA_PATH}/babylm_data_perturbed/babylm_{args.test_perturbation_type}/babylm_dev/*"))
+    test_files = list_token_files(
+        f"{BABYLM_DATA_PATH}/babylm_data_perturbed/babylm_{args.test_perturbation_type}/babylm_dev")
 
     FILE_SAMPLE_SIZE = 1000
     rng = default_rng(args.random_seed)
@@ -129,9 +128,7 @@ if __name__ == "__main__":
         print(test_file)
 
         # Get tokens from test file and subsample
-        f = open(test_file, 'r')
-        file_token_sequences = [
-            [int(s) for s in l.split()] for l in f.readlines()]
+        file_token_sequences = read_token_sequences(test_file)
         sample_indices = rng.choice(
             list(range(len(file_token_sequences))), FILE_SAMPLE_SIZE, replace=False)
         file_token_sequences = [file_token_sequences[i]
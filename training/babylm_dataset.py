@@ -5,6 +5,7 @@ import datasets
 import os
 import glob
 import tqdm
+import numpy as np
 from numpy.random import default_rng
 from itertools import product
 
@@ -27,6 +28,19 @@ _RANDOM_SEEDS = [0, 14, 41, 53, 96]
 _TRAIN_SETS = ["100M", "10M"]
 _EOS_TOKEN_ID = 50256
 
+# Binary token files written by perturb.py: uint16 token ids (.bin) and
+# int64 sequence offsets (.idx)
+_TOKEN_BIN_EXT = ".bin"
+_TOKEN_IDX_EXT = ".idx"
+
+
+def _read_token_file(path):
+    offsets = np.fromfile(path + _TOKEN_IDX_EXT, dtype="<i8")
+    if offsets[-1] == 0:
+        return []
+    tokens = np.memmap(path + _TOKEN_BIN_EXT, dtype="<u2", mode="r")
+    return [tokens[offsets[i]:offsets[i+1]].tolist() for i in range(len(offsets) - 1)]
+
 
 class BabyConfig(datasets.BuilderConfig):
 
@@ -91,6 +105,11 @@ class BabyLMCorpus(datasets.GeneratorBasedBuilder):
         logger.info("Loading pre-tokenized data")
         tokenized_sentences = []
         for sent in tqdm.tqdm(sentences):
+            # Sequences from binary token files are already tokenized
+            if not isinstance(sent, str):
+                if sent:
+                    tokenized_sentences.append(sent)
+                continue
             stripped = sent.strip()
             if not stripped:
                 continue  # Skip empty lines
@@ -157,11 +176,17 @@ class BabyLMCorpus(datasets.GeneratorBasedBuilder):
         logger.info("Generating examples from = %s", data_dir)
         infiles = sorted(glob.glob(os.path.join(data_dir, "*")))
 
-        # Extend sentences
+        # Extend sentences, reading binary token files instead of their text
+        # export where both exist
         all_sentences = []
         for infile in infiles:
-            f = open(infile, encoding="utf-8")
-            all_sentences.extend(f.readlines())
+            if infile.endswith(_TOKEN_IDX_EXT):
+                continue
+            if infile.endswith(_TOKEN_BIN_EXT):
+                all_sentences.extend(_read_token_file(infile[:-len(_TOKEN_BIN_EXT)]))
+            elif not os.path.exists(infile + _TOKEN_IDX_EXT):
+                f = open(infile, encoding="utf-8")
+                all_sentences.extend(f.readlines())
         logger.info("Total sentences: {}".format(len(all_sentences)))
 
         # Shuffle because we are pre-tokenizing
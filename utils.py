@@ -4,9 +4,13 @@
 from collections import deque
 from string import punctuation
 from transformers import AutoTokenizer, AddedToken
-from functools import partial
-from numpy.random import default_rng
+from functools import partial, lru_cache
+from numpy.random import default_rng, SeedSequence
 from nltk.tree import ParentedTree
+import numpy as np
+import itertools
+import glob
+import os
 import torch
 
 
@@ -65,6 +69,60 @@ def write_file(directory, filename, lines):
     f.close()
 
 
+##############################################################################
+# BINARY TOKEN FILES
+# A perturbed split/genre file can be stored as a flat little-endian uint16
+# array of token ids (<name>.bin) plus int64 offsets of every sequence into
+# it (<name>.idx, starting at 0). Readers take the <name> path and fall back
+# to the space-separated text format when no index exists.
+##############################################################################
+
+
+TOKEN_BIN_EXT = ".bin"
+TOKEN_IDX_EXT = ".idx"
+
+
+def write_token_arrays(directory, filename, tokens, offsets):
+    if len(tokens) > 0 and (tokens.min() < 0 or tokens.max() > np.iinfo(np.uint16).max):
+        raise ValueError(f"Token ids of {filename} do not fit in uint16")
+    np.asarray(tokens).astype("<u2").tofile(directory + filename + TOKEN_BIN_EXT)
+    np.asarray(offsets, dtype="<i8").tofile(directory + filename + TOKEN_IDX_EXT)
+
+
+def list_token_files(directory):
+    """
+    Sorted <name> paths of the token files in a directory, in either format.
+    """
+    names = set()
+    for path in glob.glob(os.path.join(directory, "*")):
+        if path.endswith(TOKEN_BIN_EXT) or path.endswith(TOKEN_IDX_EXT):
+            path = os.path.splitext(path)[0]
+        names.add(path)
+    return sorted(names)
+
+
+def read_token_file(path):
+    """
+    Memory-mapped (tokens, offsets) arrays of a binary token file; sequence
+    i is tokens[offsets[i]:offsets[i+1]].
+    """
+    offsets = np.fromfile(path + TOKEN_IDX_EXT, dtype="<i8")
+    if offsets[-1] == 0:
+        return np.zeros(0, dtype="<u2"), offsets
+    return np.memmap(path + TOKEN_BIN_EXT, dtype="<u2", mode="r"), offsets
+
+
+def read_token_sequences(path):
+    """
+    Token id lists of every sequence in a token file, in either format.
+    """
+    if not os.path.exists(path + TOKEN_IDX_EXT):
+        with open(path) as f:
+            return [[int(s) for s in l.split()] for l in f.readlines()]
+    tokens, offsets = read_token_file(path)
+    return [tokens[offsets[i]:offsets[i+1]].tolist() for i in range(len(offsets) - 1)]
+
+
 def get_gpt2_tokenizer_with_markers(marker_list):
     tokenizer = AutoTokenizer.from_pretrained("gpt2")
 
@@ -112,6 +170,92 @@ bos_token_id = gpt2_det_tokenizer.get_added_vocab()[BOS_TOKEN]
 
 
 MARKER_TOKEN_IDS = [marker_sg_token, marker_pl_token, marker_rev_token]
+ADDED_TOKENS = [MARKER_HOP_SING, MARKER_HOP_PLUR, MARKER_REV, BOS_TOKEN]
+
+
+def get_gpt2_alignment(sent_text, words):
+    """
+    Encode sentence text with the base GPT-2 tokenizer and align each word
+    to the [start, end) range of tokens that overlap it. Words are located
+    in the text from left to right; a word that cannot be found gets an
+    empty range.
+    """
+    encoded = gpt2_original_tokenizer(
+        sent_text, return_offsets_mapping=True)
+    offsets = encoded["offset_mapping"]
+
+    spans = []
+    cursor = 0
+    t = 0
+    for word in words:
+        start = sent_text.find(word, cursor) if len(word) > 0 else -1
+        if start < 0:
+            spans.append([t, t])
+            continue
+        end = start + len(word)
+        cursor = end
+
+        while t < len(offsets) and offsets[t][1] <= start:
+            t += 1
+        k = t
+        while k < len(offsets) and offsets[k][0] < end:
+            k += 1
+        spans.append([t, k])
+
+    return encoded["input_ids"], spans
+
+
+class SentenceContext(dict):
+    """
+    A sentence annotation that memoizes values derived from it, such as
+    tokenizations and hop placements, so that the perturbation, affect and
+    filter functions applied to it compute each of them once. Memoized
+    values are kept outside of the dict items.
+    """
+
+    def __init__(self, sent):
+        super().__init__(sent)
+        self.memo = {}
+
+
+def memoize(sent, key, compute):
+    if not isinstance(sent, SentenceContext):
+        return compute()
+    if key not in sent.memo:
+        sent.memo[key] = compute()
+    return sent.memo[key]
+
+
+def __stored_gpt2_ids(sent, tokenizer):
+    # Shared with the sentence, callers must not modify it
+    if "gpt2_ids" in sent and \
+            not any(token in sent["sent_text"] for token in ADDED_TOKENS):
+        return sent["gpt2_ids"]
+    return memoize(sent, ("gpt2_ids", id(tokenizer)),
+                   lambda: tokenizer.encode(sent["sent_text"]))
+
+
+def get_gpt2_ids(sent, tokenizer=gpt2_original_tokenizer):
+    """
+    GPT-2 ids of the sentence text. Base ids stored by tag.py --gpt2 are
+    reused unless the text contains one of the added marker tokens, which
+    tokenizer may split differently.
+    """
+    return list(__stored_gpt2_ids(sent, tokenizer))
+
+
+def add_gpt2_ids(sents):
+    """
+    Store base GPT-2 ids on every sentence that does not have them yet,
+    encoding all of their texts in one call to the fast tokenizer. Later
+    get_gpt2_ids calls on these sentences then skip tokenization.
+    """
+    missing = [sent for sent in sents if "gpt2_ids" not in sent]
+    if len(missing) == 0:
+        return
+    encoded = gpt2_original_tokenizer([sent["sent_text"] for sent in missing])
+    for sent, ids in zip(missing, encoded["input_ids"]):
+        sent["gpt2_ids"] = ids
 
 
 def compute_surprisals(model, input_ids):
@@ -178,13 +322,125 @@ def __perturb_hop_words(sent, num_hops, marker_sg, marker_pl):
 
 
 def check_word_hops_completed(sent, num_hops=4, marker=MARKER_HOP_SING):
-    _, hops_completed = __perturb_hop_words_complete_hops(
-        sent, num_hops, marker, marker)
-    return hops_completed
+    # Whether all hops were completed does not depend on the markers
+    return memoize(sent, ("hop_words_completed", num_hops),
+                   lambda: __place_hop_words(sent, num_hops, marker, marker)[1])
 
 
 def __perturb_hop_words_complete_hops(sent, num_hops, marker_sg, marker_pl):
 
+    def perturb():
+        new_sent, hops_completed = __place_hop_words(
+            sent, num_hops, marker_sg, marker_pl)
+        memoize(sent, ("hop_words_completed", num_hops), lambda: hops_completed)
+        sent_string = " ".join(merge_part_tokens(new_sent))
+        return gpt2_hop_tokenizer.encode(sent_string), hops_completed
+
+    tokens, hops_completed = memoize(
+        sent, ("hop_words", num_hops, marker_sg, marker_pl), perturb)
+    return list(tokens), hops_completed
+
+
+def __is_hop_special(text):
+    # Parts and punctuation are not counted as hops
+    return text in PART_TOKENS or set(text).issubset(PUNCT_TOKENS)
+
+
+def __place_hop_words(sent, num_hops, marker_sg, marker_pl):
+    """
+    Words of the sentence with each 3rd person present verb lemmatized and
+    its marker placed num_hops words before it, and whether every marker
+    made all of its hops.
+
+    This gives the same output as __place_hop_words_quadratic in linear
+    time. The reversed sentence is a linked list of nodes, so a marker is
+    inserted in constant time, and each node's PART/PUNCT flag is computed
+    once. A node has an alphanumeric word before it exactly when it comes
+    after the first alphanumeric node, which is tracked as words are added.
+    """
+    texts = []
+    special = []
+    prev = []
+    tail = None
+    first_alnum = None
+    hop_completed = []
+
+    for word in reversed(sent["word_annotations"]):
+        is_verb = __affect_hop_word(word)
+        text = word["text"]
+        if is_verb:
+            # Lemmatize verb if possible
+            text = word["lemma"] if word["lemma"] is not None else word["text"]
+
+        node = len(texts)
+        texts.append(text)
+        special.append(__is_hop_special(text))
+        prev.append(tail)
+        tail = node
+        if first_alnum is None and any(c.isalnum() for c in text):
+            first_alnum = node
+        if not is_verb:
+            continue
+
+        # Marker hopping logic. Stop when only punctuation remains before
+        # the node.
+        skipped_words = 0
+        while skipped_words < num_hops and prev[node] is not None:
+            if first_alnum is None or node == first_alnum:
+                break
+            if not special[node]:
+                skipped_words += 1
+            node = prev[node]
+
+        # Move the insert position off punctuation (and this is not
+        # sentence-initial punctuation)
+        passed_first_alnum = False
+        if first_alnum is not None and node != first_alnum:
+            while prev[node] is not None and special[node]:
+                passed_first_alnum |= node == first_alnum
+                node = prev[node]
+
+        # Handle edge case when token before insert position is part/aux token
+        if prev[node] is not None and texts[prev[node]] in PART_TOKENS:
+            passed_first_alnum |= node == first_alnum
+            node = prev[node]
+
+        # Log if this sentence had all full hops
+        hop_completed.append(skipped_words == num_hops)
+
+        # Use correct marker for singular vs. plural
+        if "Number=Sing" in word["feats"]:
+            marker = marker_sg
+        elif "Number=Plur" in word["feats"]:
+            marker = marker_pl
+        else:
+            raise Exception(
+                "Number not in verb features\n" + sent["sent_text"])
+
+        # Link the marker in before the insert position
+        marker_node = len(texts)
+        texts.append(marker)
+        special.append(__is_hop_special(marker))
+        prev.append(prev[node])
+        prev[node] = marker_node
+        if any(c.isalnum() for c in marker) and (
+                first_alnum is None or node == first_alnum or passed_first_alnum):
+            first_alnum = marker_node
+
+    # Walking back from the tail restores sentence order
+    new_sent = []
+    node = tail
+    while node is not None:
+        new_sent.append(texts[node])
+        node = prev[node]
+    return new_sent, all(hop_completed) and len(hop_completed) > 0
+
+
+def __place_hop_words_quadratic(sent, num_hops, marker_sg, marker_pl):
+    """
+    Original implementation of __place_hop_words, kept as a reference.
+    """
+
     word_annotations = sent["word_annotations"].copy()
     word_annotations.reverse()
 
@@ -244,13 +500,98 @@ def __perturb_hop_words_complete_hops(sent, num_hops, marker_sg, marker_pl):
             new_sent.append(word["text"])
 
     new_sent.reverse()
-    sent_string = " ".join(merge_part_tokens(new_sent))
-    tokens = gpt2_hop_tokenizer.encode(sent_string)
-    return tokens, all(hop_completed) and len(hop_completed) > 0
+    return new_sent, all(hop_completed) and len(hop_completed) > 0
+
+
+# Hop word placement engines, which give identical output
+HOP_WORD_PLACEMENTS = {
+    "linear": __place_hop_words,
+    "quadratic": __place_hop_words_quadratic,
+}
+
+
+def __hop_token_segments(sent):
+    """
+    Splits the sentence before each 3rd-person present verb, working from
+    the end of the sentence. Returns the steps that build its tokens from
+    the back: encoded segments to prepend and the marker to insert after
+    each verb. All segments are encoded in one batched tokenizer call.
+    """
+
+    word_annotations = sent["word_annotations"].copy()
+    word_annotations.reverse()
+
+    steps = []
+    new_sent = deque()
+    for word in word_annotations:
+
+        # Identify 3.pres verbs
+        if __affect_hop_word(word):
+
+            # Lemmatize verb if possible
+            lemma = word["lemma"] if word["lemma"] is not None else word["text"]
+
+            if len(new_sent) > 0 and new_sent[0] in PART_TOKENS:
+                lemma = lemma + new_sent[0]
+                new_sent.popleft()
+
+            if len(new_sent) > 0:
+                steps.append(" " + " ".join(merge_part_tokens(new_sent)))
+
+            # Use correct marker for singular vs. plural
+            if "Number=Sing" in word["feats"]:
+                steps.append(marker_sg_token)
+            elif "Number=Plur" in word["feats"]:
+                steps.append(marker_pl_token)
+            else:
+                raise Exception(
+                    "Number not in verb features\n" + sent["sent_text"])
+
+            new_sent = deque()
+            new_sent.append(lemma)
+
+        else:
+            new_sent.appendleft(word["text"])
+
+    if len(new_sent) > 0:
+        steps.append(" ".join(merge_part_tokens(new_sent)))
+
+    texts = [step for step in steps if isinstance(step, str)]
+    if len(texts) == 0:
+        return steps
+    encoded = iter(gpt2_hop_tokenizer(texts)["input_ids"])
+    return [next(encoded) if isinstance(step, str) else step
+            for step in steps]
 
 
 def __perturb_hop_tokens(sent, num_hops):
 
+    # Segmentation does not depend on num_hops, so hop_tokens4 and
+    # hop_control share it
+    steps = memoize(sent, ("hop_token_segments",),
+                    lambda: __hop_token_segments(sent))
+
+    # Tokens are kept reversed, so prepending a segment is an append and a
+    # marker num_hops tokens from the front is num_hops from the end
+    reversed_tokens = []
+    for step in steps:
+        if isinstance(step, list):
+            reversed_tokens.extend(reversed(step))
+        else:
+            moved = [reversed_tokens.pop()
+                     for _ in range(min(num_hops, len(reversed_tokens)))]
+            reversed_tokens.append(step)
+            reversed_tokens.extend(reversed(moved))
+
+    reversed_tokens.reverse()
+    return reversed_tokens
+
+
+def __perturb_hop_tokens_quadratic(sent, num_hops):
+    """
+    Original implementation of __perturb_hop_tokens, kept as a reference.
+    """
+
     word_annotations = sent["word_annotations"].copy()
     word_annotations.reverse()
 
@@ -294,10 +635,17 @@ def __perturb_hop_tokens(sent, num_hops):
     return tokens
 
 
+# Hop token engines, which give identical output
+HOP_TOKEN_ENGINES = {
+    "linear": __perturb_hop_tokens,
+    "quadratic": __perturb_hop_tokens_quadratic,
+}
+
+
 def __perturb_reverse(sent, rng, reverse, full):
 
     # Get sentence text and GPT-2 tokens
-    tokens = gpt2_rev_tokenizer.encode(sent["sent_text"])
+    tokens = get_gpt2_ids(sent, gpt2_rev_tokenizer)
 
     # Pick random index to insert REV token
     i = rng.choice(len(tokens)+1)
@@ -316,18 +664,33 @@ def __perturb_reverse(sent, rng, reverse, full):
     return new_tokens
 
 
+@lru_cache(maxsize=None)
+def __shuffle_permutation(seed, length):
+    """
+    The order in which default_rng(seed).shuffle leaves a list of the given
+    length, as indices into it. Sentences are capped at 1024 tokens, so each
+    seed has at most 1025 of these.
+    """
+    permutation = list(range(length))
+    default_rng(seed).shuffle(permutation)
+    return np.array(permutation, dtype=np.int64)
+
+
+@lru_cache(maxsize=None)
+def __local_shuffle_permutation(seed, window, length):
+    # Every window is shuffled by a fresh generator, the last one possibly
+    # shorter than the others
+    return np.concatenate(
+        [i + __shuffle_permutation(seed, min(window, length - i))
+         for i in range(0, length, window)] or [np.zeros(0, dtype=np.int64)])
+
+
 def __perturb_shuffle_deterministic(sent, seed, shuffle):
     # Get sentence text and GPT-2 tokens
-    # tokens = gpt2_original_tokenizer.encode(sent["sent_text"],truncation=True, max_length=1024 )
-    encoded = gpt2_original_tokenizer(
-        sent["sent_text"],
-        truncation=True,
-        max_length=1024,
-        return_tensors=None,
-    )
-    tokens = encoded["input_ids"]
+    tokens = get_gpt2_ids(sent)[:1024]
     if shuffle:
-        default_rng(seed).shuffle(tokens)
+        tokens = np.array(tokens)[
+            __shuffle_permutation(seed, len(tokens))].tolist()
     if len(tokens) > 1024:
         tokens = tokens[:1024]
 
@@ -336,14 +699,7 @@ def __perturb_shuffle_deterministic(sent, seed, shuffle):
 
 def __perturb_shuffle_nondeterministic(sent, rng):
     # Get sentence text and GPT-2 tokens
-    # tokens = gpt2_original_tokenizer.encode(sent["sent_text"], truncation=True,    max_length=1024 )
-    encoded = gpt2_original_tokenizer(
-        sent["sent_text"],
-        truncation=True,
-        max_length=1024,
-        return_tensors=None,
-    )
-    tokens = encoded["input_ids"]
+    tokens = get_gpt2_ids(sent)[:1024]
     rng.shuffle(tokens)
     if len(tokens) > 1024:
         tokens = tokens[:1024]
@@ -353,21 +709,16 @@ def __perturb_shuffle_nondeterministic(sent, rng):
 
 def __perturb_shuffle_local(sent, seed, window=5):
     # Get sentence text and GPT-2 tokens
-    tokens = gpt2_original_tokenizer.encode(sent["sent_text"] , truncation=True, max_length=1024)
+    tokens = get_gpt2_ids(sent)[:1024]
 
     # Shuffle tokens in batches of size window
-    shuffled_tokens = []
-    for i in range(0, len(tokens), window):
-        batch = tokens[i:i+window].copy()
-        default_rng(seed).shuffle(batch)
-        shuffled_tokens += batch
-
-    return shuffled_tokens
+    return np.array(tokens)[
+        __local_shuffle_permutation(seed, window, len(tokens))].tolist()
 
 
 def __perturb_shuffle_even_odd(sent):
     # Get sentence text and GPT-2 tokens
-    tokens = gpt2_original_tokenizer.encode(sent["sent_text"])
+    tokens = get_gpt2_ids(sent)
     even = [tok for i, tok in enumerate(tokens) if i % 2 == 0]
     odd = [tok for i, tok in enumerate(tokens) if i % 2 != 0]
     return even + odd
@@ -383,8 +734,9 @@ def __perturb_shuffle_even_odd(sent):
 
 
 def affect_hop(sent):
-    return any([__affect_hop_word(word) for word in sent['word_annotations']]) \
-        and sent["constituency_parse"] is not None
+    return memoize(sent, "affect_hop", lambda: any(
+        [__affect_hop_word(word) for word in sent['word_annotations']])
+        and sent["constituency_parse"] is not None)
 
 
 def affect_reverse(sent):
@@ -420,7 +772,7 @@ def filter_reverse(sent):
 
 
 def filter_shuffle(sent):
-    tokens = gpt2_original_tokenizer.encode(sent["sent_text"])
+    tokens = get_gpt2_ids(sent)
     return len(tokens) > 1 and len(tokens) <= 350
 
 
@@ -469,6 +821,226 @@ def perturb_shuffle_even_odd(sent):
     return __perturb_shuffle_even_odd(sent)
 
 
+# Perturbations that only read GPT-2 tokens of the sentence text
+TOKEN_PERTURBATIONS = [
+    perturb_reverse,
+    perturb_shuffle_deterministic,
+    perturb_shuffle_nondeterministic,
+    perturb_shuffle_local,
+    perturb_shuffle_even_odd,
+]
+
+
+def is_token_perturbation(perturbation_function):
+    return getattr(perturbation_function, "func", perturbation_function) \
+        in TOKEN_PERTURBATIONS
+
+
+##############################################################################
+# RAGGED TOKEN BATCHES
+# Most token-level perturbations only reorder the tokens of a sentence. For
+# a batch of sentences, their ids are stored in one flat array with the
+# offsets of each sentence, and the perturbation is computed as a single
+# gather index over the whole batch.
+##############################################################################
+
+
+def __ragged_ids(sents, tokenizer=gpt2_original_tokenizer, max_length=None):
+    ids = [__stored_gpt2_ids(sent, tokenizer) for sent in sents]
+    if max_length is not None:
+        ids = [tokens[:max_length] if len(tokens) > max_length else tokens
+               for tokens in ids]
+    lengths = np.array([len(tokens) for tokens in ids], dtype=np.int64)
+    flat = np.fromiter(itertools.chain.from_iterable(ids), dtype=np.int64,
+                       count=lengths.sum())
+    return flat, lengths
+
+
+def __ragged_positions(lengths):
+    # Start of the sentence and position within it, for every token
+    starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return starts, np.arange(lengths.sum()) - starts
+
+
+def __ragged_split(flat, lengths):
+    tokens = flat.tolist()
+    ends = np.cumsum(lengths).tolist()
+    return [tokens[end - length:end] for end, length in zip(ends, lengths.tolist())]
+
+
+def __ragged_permutations(lengths, permutation):
+    # Concatenated per-sentence permutations, offset into the flat array
+    if len(lengths) == 0:
+        return np.zeros(0, dtype=np.int64)
+    starts, _ = __ragged_positions(lengths)
+    return starts + np.concatenate([permutation(length) for length in lengths.tolist()])
+
+
+def __ragged_shuffle_deterministic(sents, rngs, seed=None, shuffle=True):
+    if not shuffle:
+        return [get_gpt2_ids(sent)[:1024] for sent in sents]
+    flat, lengths = __ragged_ids(sents, max_length=1024)
+    flat = flat[__ragged_permutations(
+        lengths, lambda length: __shuffle_permutation(seed, length))]
+    return __ragged_split(flat, lengths)
+
+
+def __ragged_shuffle_local(sents, rngs, seed, window):
+    flat, lengths = __ragged_ids(sents, max_length=1024)
+    flat = flat[__ragged_permutations(
+        lengths, lambda length: __local_shuffle_permutation(seed, window, length))]
+    return __ragged_split(flat, lengths)
+
+
+def __even_odd_index(lengths):
+    starts, positions = __ragged_positions(lengths)
+
+    # Even positions first, then odd ones
+    num_even = np.repeat((lengths + 1) // 2, lengths)
+    source = np.where(positions < num_even, 2 * positions,
+                      2 * (positions - num_even) + 1)
+    return starts + source
+
+
+def __ragged_shuffle_even_odd(sents, rngs):
+    flat, lengths = __ragged_ids(sents)
+    return __ragged_split(flat[__even_odd_index(lengths)], lengths)
+
+
+def __ragged_reverse(sents, rngs, reverse=True, full=False):
+    flat, lengths = __ragged_ids(sents, gpt2_rev_tokenizer)
+
+    # Marker positions are drawn sentence by sentence, as perturb_reverse does
+    markers = np.array([rng.choice(length + 1)
+                        for rng, length in zip(rngs, lengths.tolist())], dtype=np.int64)
+
+    # Every sentence gains the marker, stored after the flat ids
+    out_lengths = lengths + 1
+    starts, positions = __ragged_positions(out_lengths)
+    length = np.repeat(lengths, out_lengths)
+    marker = np.repeat(markers, out_lengths)
+    starts -= np.repeat(np.arange(len(lengths)), out_lengths)
+    if full:
+        assert not reverse
+        positions = length - positions
+
+    if reverse:
+        after = length + marker - positions
+    else:
+        after = positions - 1
+    source = np.where(positions < marker, starts + positions, starts + after)
+    source[positions == marker] = len(flat)
+
+    flat = np.append(flat, marker_rev_token)
+    return __ragged_split(flat[source], out_lengths)
+
+
+def derive_from_control(tokens, lengths, perturbation_function):
+    """
+    Flat ids of a token-level language, computed from the flat ids and
+    sentence lengths written for its control language: shuffle_control for
+    the shuffles, reverse_control (which places REV markers with the same
+    generator) for the reversals. Raises ValueError for perturbations that
+    cannot be derived.
+    """
+    tokens = np.asarray(tokens, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    function = getattr(perturbation_function, "func", perturbation_function)
+    keywords = getattr(perturbation_function, "keywords", {})
+
+    if function is perturb_shuffle_deterministic:
+        if not keywords.get("shuffle", True):
+            return tokens
+        seed = keywords.get("seed")
+        return tokens[__ragged_permutations(
+            lengths, lambda length: __shuffle_permutation(seed, length))]
+
+    if function is perturb_shuffle_local:
+        seed, window = keywords["seed"], keywords["window"]
+        return tokens[__ragged_permutations(
+            lengths, lambda length: __local_shuffle_permutation(seed, window, length))]
+
+    if function is perturb_shuffle_even_odd:
+        return tokens[__even_odd_index(lengths)]
+
+    if function is perturb_reverse:
+        starts, positions = __ragged_positions(lengths)
+        is_marker = tokens == marker_rev_token
+        sentence = np.repeat(np.arange(len(lengths)), lengths)
+        if not np.all(np.bincount(sentence[is_marker], minlength=len(lengths)) == 1):
+            raise ValueError("Every sentence must contain exactly one REV marker")
+        marker = np.repeat(positions[is_marker], lengths)
+        length = np.repeat(lengths, lengths)
+
+        if keywords.get("full", False):
+            source = length - 1 - positions
+        elif keywords.get("reverse", True):
+            source = np.where(positions <= marker, positions,
+                              length + marker - positions)
+        else:
+            source = positions
+        return tokens[starts + source]
+
+    raise ValueError(f"{function.__name__} cannot be derived from a control language")
+
+
+RAGGED_PERTURBATIONS = {
+    perturb_reverse: __ragged_reverse,
+    perturb_shuffle_deterministic: __ragged_shuffle_deterministic,
+    perturb_shuffle_local: __ragged_shuffle_local,
+    perturb_shuffle_even_odd: __ragged_shuffle_even_odd,
+}
+
+
+def perturb_sents(sents, perturbation_function, rngs=None):
+    """
+    Apply a perturbation function to a list of sentences. For token-level
+    perturbations, all sentences are tokenized together first, and those in
+    RAGGED_PERTURBATIONS are computed for the whole batch at once. With
+    rngs, the i-th sentence draws from rngs[i] instead of the bound
+    generator.
+    """
+    if is_token_perturbation(perturbation_function):
+        add_gpt2_ids(sents)
+
+    function = getattr(perturbation_function, "func", perturbation_function)
+    if function in RAGGED_PERTURBATIONS:
+        keywords = dict(getattr(perturbation_function, "keywords", {}))
+        rng = keywords.pop("rng", None)
+        if rngs is None:
+            rngs = [rng] * len(sents)
+        return RAGGED_PERTURBATIONS[function](sents, rngs, **keywords)
+
+    if rngs is None:
+        return [perturbation_function(sent) for sent in sents]
+    return [perturbation_function(sent, rng=rng) for sent, rng in zip(sents, rngs)]
+
+
+##############################################################################
+# PER-SENTENCE RANDOM STREAMS
+# Randomized perturbations share one generator bound in PERTURBATIONS, so
+# their output depends on visiting sentences serially. To perturb sentences
+# in any order, each sentence instead gets its own generator derived from
+# the shared generator's seed and the sentence's position in its file.
+##############################################################################
+
+
+def get_rng_seed(perturbation_function):
+    """
+    Seed of the generator bound to a perturbation function, or None if the
+    perturbation does not draw random numbers.
+    """
+    keywords = getattr(perturbation_function, "keywords", {})
+    if keywords.get("rng") is None:
+        return None
+    return keywords["rng"].bit_generator.seed_seq.entropy
+
+
+def get_sentence_rng(seed, file_key, line_index, sent_index):
+    return default_rng(SeedSequence(
+        seed, spawn_key=(file_key, line_index, sent_index)))
+
+
 ##############################################################################
 # PERTURBATIONS
 # This dict maps the name of a perturbation to its perturbation and filter
@@ -629,3 +1201,51 @@ PERTURBATIONS = {
         "color": "#03a0ff",
     },
 }
+
+
+##############################################################################
+# TAGGING PROFILES
+# These define which Stanza processors tag.py runs and which annotations it
+# stores. Token-level perturbations only read the sentence text, so they only
+# need tokenization; the hop perturbations need POS, lemmas and features of
+# every word.
+##############################################################################
+
+
+TAGGING_PROFILES = {
+    # Full annotations with lemmatized sentence text
+    "default": {
+        "processors": "tokenize,pos,lemma",
+        "sent_text": "lemma",
+        "word_annotations": True,
+    },
+    "full": {
+        "processors": "tokenize,pos,lemma",
+        "sent_text": "text",
+        "word_annotations": True,
+    },
+    "lemma": {
+        "processors": "tokenize,pos,lemma",
+        "sent_text": "lemma",
+        "word_annotations": False,
+    },
+    "tokenize": {
+        "processors": "tokenize",
+        "sent_text": "text",
+        "word_annotations": False,
+    },
+}
+
+
+def get_tagging_profile(perturbation_type):
+    perturbation = PERTURBATIONS[perturbation_type]
+
+    # Hop languages read word-level lemmas and features
+    if perturbation["affect_function"] is affect_hop:
+        return "full"
+
+    # Lemma languages read lemmatized sentence text only
+    if perturbation_type.startswith("lemma_"):
+        return "lemma"
+
+    return "tokenize"